@@ -0,0 +1,5 @@
+"""
+Performance benchmarks for the RankingSaver EndMap pipeline.
+
+Run with ``python -m benchmarks.endmap``; see ``--help`` for options.
+"""
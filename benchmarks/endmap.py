@@ -0,0 +1,246 @@
+"""
+Times each step of the EndMap pipeline and prints the results as JSON, so that runs can be compared between commits.
+
+    python -m benchmarks.endmap --lobby-sizes 8 64 512 --rounds 500 --output bench.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+from tbg.rankingsaver import get_round_result_winner, render_map_result
+from tbg.rankingsaver import encoder, fileio
+from tbg.rankingsaver.helpers import format_net_timespan
+from tbg.rankingsaver.model import RacerResult
+
+from .players import generate_players
+
+# Day file sizes (in rounds) at which update/export timings are reported.
+ROUND_CHECKPOINTS = [1, 10, 50, 100, 200, 300, 400, 500]
+
+
+def summarise(samples: list) -> dict:
+    """
+    Summarises a list of timings (in seconds) in microseconds.
+    """
+    return {
+        'runs': len(samples),
+        'min_us': min(samples) * 1e6,
+        'median_us': statistics.median(samples) * 1e6,
+        'mean_us': statistics.mean(samples) * 1e6,
+        'max_us': max(samples) * 1e6,
+    }
+
+
+async def time_async(func, *args, repeat: int) -> dict:
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        await func(*args)
+        samples.append(time.perf_counter() - start)
+    return summarise(samples)
+
+
+def time_sync(func, *args, repeat: int) -> dict:
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        samples.append(time.perf_counter() - start)
+    return summarise(samples)
+
+
+async def bench_lobby(lobby_size: int, args) -> dict:
+    players = generate_players(lobby_size, tie_rate=args.tie_rate, dnf_rate=args.dnf_rate, seed=args.seed)
+    round_result = await render_map_result('$o$f00Bench $fffTrack', players, [])
+    times = [p['best_race_time'] for p in players if p['best_race_time'] > 0]
+
+    def format_all():
+        for t in times:
+            format_net_timespan(t)
+
+    return {
+        'render_map_result': await time_async(render_map_result, '$o$f00Bench $fffTrack', players, [],
+                                              repeat=args.repeat),
+        'get_round_result_winner': await time_async(get_round_result_winner, round_result, repeat=args.repeat),
+        'format_net_timespan': time_sync(format_all, repeat=args.repeat),
+        'dump_mapend_raw': await time_async(fileio.dump_mapend_raw, players, [], repeat=args.repeat),
+    }
+
+
+def retained_bytes(build) -> int:
+    """
+    Returns how many bytes of memory the object returned by build keeps alive.
+    """
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        result = build()
+        retained = tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+    del result
+    return retained
+
+
+async def bench_model(lobby_size: int, args) -> dict:
+    """
+    Compares the slotted RoundResult and its encoder against the plain dicts and json.dumps they replaced.
+    """
+    players = generate_players(lobby_size, tie_rate=args.tie_rate, dnf_rate=args.dnf_rate, seed=args.seed)
+    round_result = await render_map_result('Bench Track', players, [])
+    as_dict = round_result.to_dict()
+
+    return {
+        'orjson': encoder.orjson is not None,
+        'retained_bytes_model': retained_bytes(lambda: [RacerResult(r.nick, r.rank, r.best_time)
+                                                        for r in round_result.racer_results]),
+        'retained_bytes_dict': retained_bytes(lambda: [dict(r) for r in as_dict['RacerResults']]),
+        'journal_line_bytes': len((encoder.dumps(round_result) + '\n').encode("utf-8")),
+        'journal_line_bytes_json': len((json.dumps(as_dict) + '\n').encode("utf-8")),
+        'encode_compact': time_sync(encoder.dumps, round_result, repeat=args.repeat),
+        'encode_indented': time_sync(encoder.dumps, round_result, True, '        ', repeat=args.repeat),
+        'encode_json': time_sync(json.dumps, as_dict, repeat=args.repeat),
+        'encode_json_indented': time_sync(lambda: json.dumps(as_dict, indent=4), repeat=args.repeat),
+    }
+
+
+async def bench_day_growth(lobby_size: int, args) -> dict:
+    """
+    Plays a whole day of rounds into an empty matchresults directory, timing each update and export.
+    """
+    players = generate_players(lobby_size, tie_rate=args.tie_rate, dnf_rate=args.dnf_rate, seed=args.seed)
+    round_result = await render_map_result('Bench Track', players, [])
+
+    update_samples = []
+    export_samples = []
+    for _ in range(args.rounds):
+        start = time.perf_counter()
+        await fileio.update_matchresult(round_result)
+        update_samples.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await fileio.export_matchresult()
+        export_samples.append(time.perf_counter() - start)
+
+    return {
+        'update_matchresult': {str(n): update_samples[n - 1] * 1e6 for n in ROUND_CHECKPOINTS if n <= args.rounds},
+        'export_matchresult': {str(n): export_samples[n - 1] * 1e6 for n in ROUND_CHECKPOINTS if n <= args.rounds},
+        'update_matchresult_total_us': sum(update_samples) * 1e6,
+        'export_matchresult_total_us': sum(export_samples) * 1e6,
+    }
+
+
+async def bench_map_writes(lobby_size: int, args) -> dict:
+    """
+    Plays a day of maps into an empty matchresults directory the way a live server does, committing each round
+    without exporting the day file in between, and compares the per-map write cost at the start and end of the day.
+    """
+    players = generate_players(lobby_size, tie_rate=args.tie_rate, dnf_rate=args.dnf_rate, seed=args.seed)
+    round_result = await render_map_result('Bench Track', players, [])
+    window = min(20, args.write_maps)
+
+    samples = []
+    for _ in range(args.write_maps):
+        start = time.perf_counter()
+        await fileio.update_matchresult(round_result)
+        samples.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await fileio.export_matchresult()
+    export_us = (time.perf_counter() - start) * 1e6
+
+    first, last = statistics.median(samples[:window]), statistics.median(samples[-window:])
+    return {
+        'maps': args.write_maps,
+        'first_maps_median_us': first * 1e6,
+        'last_maps_median_us': last * 1e6,
+        'last_to_first_ratio': last / first,
+        'final_export_us': export_us,
+    }
+
+
+def fresh_matchresults(name: str):
+    """
+    Switches to an empty matchresults directory, forgetting everything fileio has cached about the last one.
+    """
+    os.makedirs(os.path.join(name, 'matchresults'))
+    os.chdir(name)
+    fileio._day_caches.clear()
+    fileio._standings = None
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(__file__),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+async def run(args) -> dict:
+    report = {
+        'meta': {
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'started_at_utc': datetime.utcnow().isoformat(),
+            'args': vars(args),
+        },
+        'lobbies': {},
+        'model': {},
+        'day_growth': {},
+        'map_writes': {},
+    }
+
+    # Everything is written relative to the working directory, so do it somewhere disposable.
+    with tempfile.TemporaryDirectory() as workdir:
+        cwd = os.getcwd()
+        os.chdir(workdir)
+        try:
+            os.makedirs('matchresults')
+            for lobby_size in args.lobby_sizes:
+                report['lobbies'][str(lobby_size)] = await bench_lobby(lobby_size, args)
+                report['model'][str(lobby_size)] = await bench_model(lobby_size, args)
+            report['day_growth'][str(args.day_lobby_size)] = await bench_day_growth(args.day_lobby_size, args)
+            fresh_matchresults(os.path.join(workdir, 'map_writes'))
+            report['map_writes'][str(args.day_lobby_size)] = await bench_map_writes(args.day_lobby_size, args)
+        finally:
+            os.chdir(cwd)
+
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the RankingSaver EndMap pipeline.')
+    parser.add_argument('--lobby-sizes', type=int, nargs='+', default=[8, 64, 512, 4096])
+    parser.add_argument('--tie-rate', type=float, default=0.05)
+    parser.add_argument('--dnf-rate', type=float, default=0.1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=20, help='Runs per lobby benchmark.')
+    parser.add_argument('--rounds', type=int, default=500, help='Rounds to play into the day file.')
+    parser.add_argument('--write-maps', type=int, default=200, help='Maps to commit without exporting in between.')
+    parser.add_argument('--day-lobby-size', type=int, default=64)
+    parser.add_argument('--output', help='Write the JSON report here instead of stdout.')
+    args = parser.parse_args(argv)
+
+    report = asyncio.run(run(args))
+
+    if args.output:
+        with open(args.output, 'w', encoding="utf-8") as output_file:
+            json.dump(report, output_file, indent=4)
+    else:
+        json.dump(report, sys.stdout, indent=4)
+        sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+"""
+Synthetic PyPlanet-like ``players`` lists, as passed to the ``scores`` callback at EndMap.
+"""
+import random
+from types import SimpleNamespace
+from typing import List, Optional
+
+# A few Maniaplanet styles, so that nickname stripping has something to do.
+NICKNAME_STYLES = ['', '$o', '$i$f00', '$s$0af', '$w$fff', '$l[https://thebiggame.org]$n$f80']
+
+
+def generate_players(lobby_size: int, tie_rate: float = 0.05, dnf_rate: float = 0.1,
+                     seed: Optional[int] = 0) -> List[dict]:
+    """
+    Generates a synthetic lobby.
+
+    Parameters:
+    lobby_size (int): How many players to generate.
+    tie_rate (float): Chance that a finishing player exactly ties the previous finisher's time.
+    dnf_rate (float): Chance that a player did not set a time (best_race_time of -1 or 0).
+    seed (int): Random seed, so that runs are comparable between commits.
+
+    Returns:
+    List[dict]: Player score dicts with the keys the plugin reads.
+    """
+    rng = random.Random(seed)
+    players = []
+    previous_time = None
+    for i in range(lobby_size):
+        if rng.random() < dnf_rate:
+            best_race_time = rng.choice([-1, 0])
+        elif previous_time is not None and rng.random() < tie_rate:
+            best_race_time = previous_time
+        else:
+            best_race_time = rng.randint(25000, 90000)
+            previous_time = best_race_time
+
+        checkpoints = []
+        if best_race_time > 0:
+            checkpoints = sorted(rng.randint(1, best_race_time) for _ in range(7)) + [best_race_time]
+
+        login = f'bench_player_{i:05d}'
+        players.append(dict(
+            player=SimpleNamespace(
+                login=login,
+                nickname=f'{rng.choice(NICKNAME_STYLES)}Racer{i:05d}',
+            ),
+            best_race_time=best_race_time,
+            best_lap_time=best_race_time,
+            best_race_checkpoints=checkpoints,
+        ))
+
+    return players
@@ -0,0 +1,512 @@
+import asyncio
+import cProfile
+import functools
+import logging
+import os
+import random
+from datetime import datetime
+
+from pyplanet.apps.config import AppConfig
+from pyplanet.apps.core.maniaplanet import callbacks as mp_signals
+from pyplanet.apps.core.trackmania import callbacks as tm_signals
+from pyplanet.contrib.command import Command
+from pyplanet.contrib.setting import Setting
+
+from .fileio import update_matchresult, dump_mapend_raw, export_matchresult, export_pending_matchresults, \
+    io_latency_stats, write_metrics, write_live_standings, standings_table, open_result_store, \
+    close_result_store, query_result_store, read_state, write_state, set_server_id, save_standings, \
+    start_io_profile, stop_io_profile, dump_profile
+from .helpers import format_net_timespan, strip_cache_stats, strip_styles
+from . import metrics
+from .leaderboard import LiveLeaderboard
+from .outbound import OutboundBatcher
+from .push import PushServer
+from .recovery import recover_matchresults
+from .rendering import get_round_result_winner, render_map_result, render_live_standings
+from .store import ResultStore
+
+logger = logging.getLogger(__name__)
+
+# These messages are displayed as a congratulations to the winner of each round
+# when tracking is enabled.
+winner_congrats_messages = [
+    'Maximum BIGGAMER points for you!',
+    'Your Sunday morning display of speed impresses us.',
+    'Seriously fast stuff.',
+    'And you managed it without throwing your keyboard across the room.',
+    'Your victory shall be remembered as fondly as Gribley\'s Eiffel Tower model.',
+]
+
+# How often (in seconds) the day journal is compacted into the Scorematron day file.
+MATCHRESULT_EXPORT_INTERVAL = 10
+
+# How often (in seconds) the live standings snapshot is rewritten while a map is being played.
+LIVE_STANDINGS_INTERVAL = 2
+
+
+class RankingSaverApp(AppConfig):
+    """
+    Save Rankings to JSON files.
+    """
+
+    game_dependencies = ['trackmania_next', 'trackmania']
+    # PyPlanet matches these against the script name by substring, so 'Teams' covers TM_Teams_Online and
+    # TM_TMWTTeams_Online, where team standings are computed.
+    mode_dependencies = ['TimeAttack', 'Teams']
+    app_dependencies = ['core.maniaplanet', 'core.trackmania']
+
+    namespace = 'tbg'
+
+    def __init__(self, *args, **kwargs):
+        """
+        Initializes the plugin.
+        """
+        super().__init__(*args, **kwargs)
+
+        self.enabled = False
+        self.running = False
+        self.export_task = None
+        self.live_standings_task = None
+        self.leaderboard = LiveLeaderboard()
+
+        self.setting_result_store = Setting(
+            'result_store', 'Save results to SQLite', Setting.CAT_BEHAVIOUR, type=bool, default=False,
+            description='Also save every round to matchresults/results.sqlite3, for history lookups.',
+            change_target=self.result_store_changed,
+        )
+        self.setting_push_port = Setting(
+            'push_port', 'Result push port', Setting.CAT_BEHAVIOUR, type=int, default=0,
+            description='Stream new results to local clients on this port (127.0.0.1 only). 0 disables it.',
+            change_target=self.push_port_changed,
+        )
+        self.setting_server_id = Setting(
+            'server_id', 'Server name for shared results', Setting.CAT_BEHAVIOUR, type=str, default='',
+            description='Set a different name on each server that shares the matchresults directory (e.g. parallel '
+                        'heats). Leave empty for a single server.',
+            change_target=self.server_id_changed,
+        )
+        self.setting_record_splits = Setting(
+            'record_splits', 'Record checkpoint splits', Setting.CAT_BEHAVIOUR, type=bool, default=False,
+            description='Also save everyone\'s best-run checkpoint times to matchresults/splits, for sector analysis.',
+        )
+        self.push_server = None
+        self.profile_next_map = False
+        # Chat messages and GBX calls go out through here, so that those made close together share a round-trip.
+        self.outbound = OutboundBatcher(self.instance)
+
+    async def on_start(self):
+        """
+        Called on starting the application.
+        """
+
+        # Init settings.
+        await self.context.setting.register(self.setting_result_store)
+        if await self.setting_result_store.get_value():
+            await open_result_store()
+        await self.context.setting.register(self.setting_push_port)
+        await self.start_push_server(await self.setting_push_port.get_value())
+        await self.context.setting.register(self.setting_server_id)
+        await self.context.setting.register(self.setting_record_splits)
+        set_server_id(await self.setting_server_id.get_value())
+
+        # Pick up where we left off if the controller was restarted mid-tournament,
+        # saving any round that was lost mid-save.
+        state = await read_state()
+        self.enabled = state.get('Enabled', False)
+        self.running = state.get('Running', False)
+        try:
+            await recover_matchresults()
+        except Exception as e:
+            logging.error(e, exc_info=e)
+
+        await self.instance.permission_manager.register(
+            'match', 'Manage Tournament Tracking', app=self, min_level=2)
+
+        # Listen to signals.
+        self.context.signals.listen(tm_signals.scores, self.scores)
+        self.context.signals.listen(mp_signals.map.map_end, self.map_end)
+        self.context.signals.listen(mp_signals.map.map_begin, self.map_begin)
+        self.context.signals.listen(tm_signals.finish, self.player_finish)
+
+        # Keep the Scorematron day file in step with the journal, and the live standings in step with the map.
+        self.export_task = asyncio.ensure_future(self.export_loop())
+        self.live_standings_task = asyncio.ensure_future(self.live_standings_loop())
+
+        # Register commands
+        # Start match logging
+        await self.instance.command_manager.register(
+            Command(command='start', aliases=['mstart'], namespace=self.namespace, target=self.match_start,
+                    perms='rankingsaver:match', admin=True, description='Start Match Recording')
+            .add_param('',
+                       nargs='*',
+                       type=str,
+                       required=False,
+                       help='Start Match Recording'))
+
+        # Stop match logging
+        await self.instance.command_manager.register(
+            Command(command='stop', aliases=['mstop'], namespace=self.namespace, target=self.match_stop,
+                    perms='rankingsaver:match', admin=True, description='Stop Match Recording')
+            .add_param('',
+                       nargs='*',
+                       type=str,
+                       required=False,
+                       help='Stop Match Recording'))
+
+        # Export today's results
+        await self.instance.command_manager.register(
+            Command(command='export', aliases=['mexport'], namespace=self.namespace, target=self.match_export,
+                    perms='rankingsaver:match', admin=True, description='Export Match Results')
+            .add_param('',
+                       nargs='*',
+                       type=str,
+                       required=False,
+                       help='Export Match Results'))
+
+        # Show overall standings
+        await self.instance.command_manager.register(
+            Command(command='standings', namespace=self.namespace, target=self.match_standings,
+                    description='Show Overall Tournament Standings'))
+
+        # Look up history
+        await self.instance.command_manager.register(
+            Command(command='best', namespace=self.namespace, target=self.match_best,
+                    description='Show Best Times on a Track')
+            .add_param('track',
+                       nargs='*',
+                       type=str,
+                       required=False,
+                       help='Track name (default: the current track)'))
+        await self.instance.command_manager.register(
+            Command(command='history', namespace=self.namespace, target=self.match_history,
+                    description='Show a Racer\'s Recent Results')
+            .add_param('nick',
+                       nargs='*',
+                       type=str,
+                       required=True,
+                       help='Racer nickname'))
+
+        # Show pipeline timings
+        await self.instance.command_manager.register(
+            Command(command='metrics', namespace=self.namespace, target=self.match_metrics,
+                    perms='rankingsaver:match', admin=True, description='Show EndMap Pipeline Timings'))
+
+        # Profile the next EndMap
+        await self.instance.command_manager.register(
+            Command(command='profile', namespace=self.namespace, target=self.match_profile,
+                    perms='rankingsaver:match', admin=True, description='Profile the Next EndMap'))
+
+        # Show disk write latency
+        await self.instance.command_manager.register(
+            Command(command='iostats', namespace=self.namespace, target=self.match_iostats,
+                    perms='rankingsaver:match', admin=True, description='Show Match Results Disk Latency'))
+
+    async def on_stop(self):
+        """
+        Called on stopping the application.
+        """
+        if self.export_task is not None:
+            self.export_task.cancel()
+        if self.live_standings_task is not None:
+            self.live_standings_task.cancel()
+        # Each step runs even if one before it failed, so that the store is closed and the push server stopped.
+        for step in [export_pending_matchresults, save_standings, close_result_store,
+                     functools.partial(self.start_push_server, 0), self.outbound.close]:
+            try:
+                await step()
+            except Exception as e:
+                logging.exception(e)
+
+    async def start_push_server(self, port: int):
+        """
+        (Re)starts the result push server on the given port, or stops it if the port is 0.
+        """
+        if self.push_server is not None:
+            await self.push_server.stop()
+            self.push_server = None
+        if port:
+            push_server = PushServer(port=port)
+            try:
+                await push_server.start()
+            except OSError as e:
+                # e.g. the port is already in use; results are still saved, just not pushed.
+                logging.error("Could not start the result push server on port %d", port, exc_info=e)
+                return
+            self.push_server = push_server
+
+    async def push_port_changed(self, old_value, new_value):
+        """
+        Called when the push port setting changes.
+        """
+        await self.start_push_server(new_value)
+
+    async def server_id_changed(self, old_value, new_value):
+        """
+        Called when the server name setting changes.
+        """
+        set_server_id(new_value)
+        await self.checkpoint_state()
+
+    async def result_store_changed(self, old_value, new_value):
+        """
+        Called when the SQLite result store setting changes.
+        """
+        if new_value:
+            await open_result_store()
+        else:
+            await close_result_store()
+
+    async def export_loop(self):
+        """
+        Periodically exports any day file whose journal has new rounds.
+        """
+        while True:
+            await asyncio.sleep(MATCHRESULT_EXPORT_INTERVAL)
+            try:
+                await export_pending_matchresults()
+                await write_metrics()
+            except Exception as e:
+                logging.exception(e)
+
+    async def live_standings_loop(self):
+        """
+        Periodically writes a live standings snapshot for the Scorematron overlay, whenever the standings have changed.
+        """
+        written_version = None
+        while True:
+            await asyncio.sleep(LIVE_STANDINGS_INTERVAL)
+            if not self.enabled or self.leaderboard.version == written_version:
+                continue
+            try:
+                written_version = self.leaderboard.version
+                await write_live_standings(
+                    render_live_standings(self.instance.map_manager.current_map.name, self.leaderboard))
+            except Exception as e:
+                logging.exception(e)
+
+    async def checkpoint_state(self):
+        """
+        Saves whether tracking is on, so that a controller restart doesn't lose it.
+        """
+        await write_state({'Enabled': self.enabled, 'Running': self.running})
+
+    async def match_start(self, player, data, **kwargs):
+        """
+        Called when the start command is given.
+        """
+        # ensure the matchresults directory exists
+        filename = "matchresults/matchresults.json"
+
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        self.enabled = True
+        self.running = True
+        await self.checkpoint_state()
+
+        message = '$o$20atBG $fff- BIGGAMER tournament tracking will begin after map resets. $20aGLHF!$z'
+        self.outbound.chat(message)
+
+        await asyncio.sleep(5)
+        await self.outbound.gbx('RestartMap')
+
+    async def match_stop(self, player, data, **kwargs):
+        """
+        Called when the stop command is given.
+        """
+        if self.enabled and self.running:
+            message = '$o$20atBG $fff- Tournament will end at the conclusion of this map.$z'
+            self.outbound.chat(message)
+            self.running = False
+            await self.checkpoint_state()
+
+    async def match_export(self, player, data, **kwargs):
+        """
+        Called when the export command is given.
+        """
+        await export_matchresult()
+        message = '$o$20atBG $fff- Match results exported.$z'
+        self.outbound.chat(message)
+
+    async def match_standings(self, player, data, **kwargs):
+        """
+        Called when the standings command is given.
+        """
+        # Any player may ask, so this only reads; the export timer writes the export file once the standings change.
+        table = await standings_table()
+        if not table:
+            message = '$o$20atBG $fff- No tournament results yet.$z'
+        else:
+            leaders = ', '.join(f'{row["Rank"]}. $z{row["Nick"]}$z$fff ({row["Points"]})' for row in table[:5])
+            message = f'$o$20atBG $fff- Overall standings: {leaders}$z'
+        self.outbound.chat(message, player)
+
+    async def match_best(self, player, data, **kwargs):
+        """
+        Called when the best command is given.
+        """
+        track_name = ' '.join(data.track) if data.track else strip_styles(self.instance.map_manager.current_map.name)
+        best_times = await query_result_store(ResultStore.best_times, track_name, 5)
+        if best_times is None:
+            message = '$o$20atBG $fff- History lookups need the SQLite result store to be enabled.$z'
+        elif not best_times:
+            message = f'$o$20atBG $fff- No times recorded on {track_name} yet.$z'
+        else:
+            times = ', '.join(f'$z{row["Nick"]}$z$fff {row["BestTime"]}' for row in best_times)
+            message = f'$o$20atBG $fff- Best on {track_name}: {times}$z'
+        self.outbound.chat(message, player)
+
+    async def match_history(self, player, data, **kwargs):
+        """
+        Called when the history command is given.
+        """
+        nick = ' '.join(data.nick)
+        history = await query_result_store(ResultStore.player_history, nick, 5)
+        if history is None:
+            message = '$o$20atBG $fff- History lookups need the SQLite result store to be enabled.$z'
+        elif not history:
+            message = f'$o$20atBG $fff- No results recorded for {nick} yet.$z'
+        else:
+            results = ', '.join(f'{row["TrackName"]} #{row["Rank"]}' for row in history)
+            message = f'$o$20atBG $fff- Recent results for {nick}: {results}$z'
+        self.outbound.chat(message, player)
+
+    async def match_metrics(self, player, data, **kwargs):
+        """
+        Called when the metrics command is given.
+        """
+        for phase in ['scores', 'scores.announce', 'render.rank', 'render.strip', 'render.format',
+                      'update_matchresult', 'dump_mapend_raw', 'lock_wait', 'io']:
+            stats = metrics.summary(phase)
+            message = (f'$o$20atBG $fff- {phase}: n={stats["count"]} p50 {stats["p50_ms"]:.1f}ms '
+                       f'p95 {stats["p95_ms"]:.1f}ms p99 {stats["p99_ms"]:.1f}ms$z')
+            self.outbound.chat(message, player)
+
+    async def match_profile(self, player, data, **kwargs):
+        """
+        Called when the profile command is given.
+        """
+        self.profile_next_map = True
+        message = '$o$20atBG $fff- The next EndMap, disk I/O threads included, will be profiled to matchresults/.$z'
+        self.outbound.chat(message, player)
+
+    async def match_iostats(self, player, data, **kwargs):
+        """
+        Called when the iostats command is given.
+        """
+        stats = io_latency_stats()
+        message = (f'$o$20atBG $fff- {stats["count"]} writes, mean {stats["mean_ms"]:.1f}ms, '
+                   f'max {stats["max_ms"]:.1f}ms, last {stats["last_ms"]:.1f}ms.$z')
+        self.outbound.chat(message, player)
+
+    async def map_begin(self, map, **kwargs):
+        """
+        Callback: map started.
+        """
+        self.leaderboard.reset()
+
+    async def player_finish(self, player, race_time, is_end_race=True, **kwargs):
+        """
+        Callback: player crossed the finish line.
+        """
+        if is_end_race and self.leaderboard.record(player.login, player.nickname, race_time):
+            if self.enabled and self.push_server is not None:
+                self.push_server.publish('Leaderboard', {
+                    'Nick': strip_styles(player.nickname),
+                    'Rank': self.leaderboard.rank(player.login),
+                    'BestTime': format_net_timespan(race_time),
+                })
+
+    async def map_end(self, map):
+        """
+        Callback: map ended.
+        """
+        if not self.running and self.enabled:
+            self.enabled = False
+            await self.checkpoint_state()
+            await export_pending_matchresults()
+            message = '$o$20atBG $fff- Tournament tracking concluded. Go get a nice Sunday morning cup of tea!$z'
+            self.outbound.chat(message)
+
+
+
+    async def scores(self, section: str, players: dict, teams: dict, **kwargs):
+        """
+        Callback: New scores are available
+        (usually because the round has ended and the podium is about to be displayed).
+        """
+        if self.enabled:
+            if section == 'EndMap':
+                # Outside team modes there are no teams to score.
+                if not kwargs.get('use_teams'):
+                    teams = []
+                profiler = None
+                if self.profile_next_map:
+                    self.profile_next_map = False
+                    profiler = cProfile.Profile()
+                    profiler.enable()
+                    start_io_profile()
+                try:
+                    with metrics.span('scores'):
+                        await self.end_map(players, teams)
+                finally:
+                    if profiler is not None:
+                        profiler.disable()
+                        # The disk work ran on the I/O threads, each profiled separately; merge it all into one file.
+                        await dump_profile(f'matchresults/profile_{datetime.utcnow().strftime("%Y%m%dT%H%M%S")}.prof',
+                                           [profiler] + stop_io_profile())
+
+    async def end_map(self, players: dict, teams: dict):
+        """
+        Saves the results of a map, announcing the winner along the way.
+        """
+        map_name = self.instance.map_manager.current_map.name
+        # The raw dump and the RoundResult share a timestamp, so that one can always be matched to the other.
+        timestr = datetime.utcnow().isoformat()
+        record_splits = await self.setting_record_splits.get_value()
+
+        # In the interest of safety, start dumping player and team information to disk straight away.
+        # It is written alongside everything below, and is waited for before anything is reported as saved.
+        raw_dump = asyncio.ensure_future(dump_mapend_raw(players, teams, map_name, timestr, record_splits))
+
+        match_error = None
+        try:
+            # Announce the winner as soon as we know who it is...
+            with metrics.span('scores.announce'):
+                round_result = await render_map_result(map_name, players, teams, self.leaderboard, timestr)
+                winner = await get_round_result_winner(round_result)
+                if winner is not None:
+                    message = (f'$o$20atBG $fff- Congratulations to $z{winner}$fff! '
+                               f'$i{random.choice(winner_congrats_messages)}$z')
+                else:
+                    message = '$o$20atBG $fff- Congratulations to... wait, nobody completed the map? Pff.$fff'
+                self.outbound.chat(message)
+
+            logging.info("Round Results:")
+            logging.info(round_result)
+            logging.debug("Style strip cache: %s", strip_cache_stats())
+
+            # ...then commit the results while the raw dump finishes.
+            await update_matchresult(round_result)
+            if self.push_server is not None:
+                self.push_server.publish('RoundResult', round_result)
+        except Exception as e:
+            match_error = e
+
+        try:
+            await raw_dump
+        except Exception as e:
+            logging.exception(e)
+            if match_error is not None:
+                # The match results failed to save too; don't let the raw dump's error hide that.
+                logging.error(match_error, exc_info=match_error)
+            message = '$o$20atBG $fff- $f00A critical error occurred saving the map results. Please await further instructions from the crew.$z'
+            self.outbound.chat(message)
+            raise e
+
+        if match_error is not None:
+            logging.error(match_error, exc_info=match_error)
+            message = '$o$20atBG $fff- An issue occurred saving the match results, but the raw data was saved successfully - don\'t panic!$z'
+            self.outbound.chat(message)
+            raise match_error
+
+        message = '$o$20atBG $fff- Map scores saved successfully.$z'
+        self.outbound.chat(message)
@@ -0,0 +1,248 @@
+"""
+The archive module stores raw map end dumps in rolling, compressed segment files instead of one file per map.
+
+Each dump is appended to the current segment as its own gzip member, and its offset is recorded in the
+segment's index file, so that any single dump can be read back without decompressing the rest of the segment.
+
+Existing raw_<timestamp>.json files can be moved into the archive with:
+
+    python -m tbg.rankingsaver.archive migrate
+
+This is safe to run while a server is saving into the same archive: each file is archived under the archive's
+lock file, which the server takes for each of its dumps too.
+"""
+import argparse
+import glob
+import gzip
+import json
+import os
+import re
+import sys
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from .encoder import dumps
+from .helpers import process_lock, tail_lines
+
+# Segments are rolled over once they grow past this size.
+MAX_SEGMENT_BYTES = 64 * 1024 * 1024
+
+
+class RawArchive:
+    """
+    A directory of segment-NNNNN.gz files, each with a segment-NNNNN.idx index of
+    one {"Key", "Offset", "Length"} JSON document per line.
+    """
+
+    # Subclasses storing something other than gzipped JSON change these.
+    segment_extension = 'gz'
+
+    def __init__(self, directory: str, max_segment_bytes: int = MAX_SEGMENT_BYTES):
+        self.directory = directory
+        self.max_segment_bytes = max_segment_bytes
+        self._index = None
+        # How far into each segment's index file (by segment) _index has read.
+        self._index_read = {}
+
+    def _segment_path(self, segment: int) -> str:
+        return os.path.join(self.directory, f"segment-{segment:05d}.{self.segment_extension}")
+
+    def _index_path(self, segment: int) -> str:
+        return os.path.join(self.directory, f"segment-{segment:05d}.idx")
+
+    def _segments(self) -> list:
+        segments = []
+        for filepath in glob.glob(os.path.join(self.directory, f"segment-*.{self.segment_extension}")):
+            match = re.fullmatch(rf'segment-(\d+)\.{re.escape(self.segment_extension)}', os.path.basename(filepath))
+            if match:
+                segments.append(int(match.group(1)))
+        return sorted(segments)
+
+    def _load_index(self) -> Dict[str, Tuple[int, int, int]]:
+        # Other servers sharing the directory append too, so read whatever the index files have gained since.
+        sizes = {}
+        for segment in self._segments():
+            if os.path.exists(self._index_path(segment)):
+                sizes[segment] = os.path.getsize(self._index_path(segment))
+        if self._index is None or any(sizes.get(segment, 0) < read for segment, read in self._index_read.items()):
+            self._index = {}
+            self._index_read = {}
+
+        for segment, size in sizes.items():
+            read = self._index_read.get(segment, 0)
+            if size > read:
+                self._index_read[segment] = self._read_index(segment, read)
+        return self._index
+
+    def _read_index(self, segment: int, offset: int) -> int:
+        with open(self._index_path(segment), 'rb') as index_file:
+            index_file.seek(offset)
+            data = index_file.read()
+
+        # A trailing partial line may still be being written, so leave it for next time.
+        end = data.rfind(b'\n') + 1
+        for line in data[:end].split(b'\n'):
+            if not line.strip():
+                continue
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # Torn line from an interrupted append; the dump it pointed at was never acknowledged.
+                continue
+            self._index[entry['Key']] = (segment, entry['Offset'], entry['Length'])
+        return offset + end
+
+    def append(self, key: str, data: dict):
+        """
+        Appends a dump to the current segment, rolling over to a new segment if it is full.
+        Both the dump and its index entry are on disk by the time this returns.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        segments = self._segments()
+        segment = segments[-1] if segments else 1
+        if os.path.exists(self._segment_path(segment)) and \
+                os.path.getsize(self._segment_path(segment)) >= self.max_segment_bytes:
+            segment += 1
+
+        member = self._encode_member(data)
+        with open(self._segment_path(segment), 'ab') as segment_file:
+            offset = segment_file.tell()
+            segment_file.write(member)
+            segment_file.flush()
+            os.fsync(segment_file.fileno())
+
+        line = json.dumps({"Key": key, "Offset": offset, "Length": len(member)}) + '\n'
+        with open(self._index_path(segment), 'a+b') as index_file:
+            start = index_file.seek(0, os.SEEK_END)
+            if start > 0:
+                index_file.seek(-1, os.SEEK_END)
+                if index_file.read(1) != b'\n':
+                    # An interrupted append left a partial line behind; end it, so this entry gets its own line.
+                    line = '\n' + line
+            index_file.write(line.encode("utf-8"))
+            index_file.flush()
+            os.fsync(index_file.fileno())
+            end = index_file.tell()
+
+        if self._index is not None and self._index_read.get(segment, 0) == start:
+            self._index[key] = (segment, offset, len(member))
+            self._index_read[segment] = end
+
+    def _encode_member(self, data) -> bytes:
+        return gzip.compress(dumps(data).encode("utf-8"))
+
+    def keys(self) -> list:
+        """
+        Returns the key of every archived dump, oldest first.
+        """
+        return sorted(self._load_index())
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._load_index()
+
+    def locate(self, key: str) -> Optional[Tuple[str, int, int]]:
+        """
+        Returns the segment path, offset and length of a dump, for use with read_member.
+        """
+        location = self._load_index().get(key)
+        if location is None:
+            return None
+        segment, offset, length = location
+        return self._segment_path(segment), offset, length
+
+    def read(self, key: str) -> Optional[dict]:
+        """
+        Reads a single dump back, decompressing only that dump.
+        """
+        location = self.locate(key)
+        if location is None:
+            return None
+        return read_member(*location)
+
+    def tail(self, count: int) -> List[Tuple[str, Tuple[str, int, int]]]:
+        """
+        Returns the key and location of the newest dumps, oldest first.
+        Only the end of the newest index files is read, however big the archive has grown.
+        """
+        entries = []
+        for segment in reversed(self._segments()):
+            if len(entries) >= count:
+                break
+            if not os.path.exists(self._index_path(segment)):
+                continue
+            segment_entries = []
+            for line in tail_lines(self._index_path(segment), count - len(entries)):
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                segment_entries.append(
+                    (entry['Key'], (self._segment_path(segment), entry['Offset'], entry['Length'])))
+            entries = segment_entries + entries
+        return entries[-count:] if count > 0 else []
+
+    def items(self) -> Iterator[Tuple[str, dict]]:
+        """
+        Yields every (key, dump), oldest first.
+        """
+        for key in self.keys():
+            yield key, self.read(key)
+
+
+def read_member(segment_path: str, offset: int, length: int) -> dict:
+    """
+    Reads and decompresses a single dump from a segment.
+    """
+    with open(segment_path, 'rb') as segment_file:
+        segment_file.seek(offset)
+        return json.loads(gzip.decompress(segment_file.read(length)).decode("utf-8"))
+
+
+def migrate_raw_files(source_directory: str, archive: RawArchive, remove: bool = False) -> int:
+    """
+    Moves raw_<timestamp>.json files into the archive, keyed by their timestamp.
+    Files that are already archived are skipped, so this can safely be re-run.
+
+    Returns:
+    int: The number of files archived.
+    """
+    migrated = 0
+    for filepath in sorted(glob.glob(os.path.join(source_directory, "raw_*.json"))):
+        key = os.path.basename(filepath)[len("raw_"):-len(".json")]
+        # The lock the server takes to dump into the archive (see fileio._archive_raw_dump), one file at a time
+        # so that the server never waits on the whole migration.
+        with process_lock(archive.directory):
+            if key not in archive:
+                with open(filepath, 'r', encoding="utf-8") as raw_file:
+                    archive.append(key, json.load(raw_file))
+                migrated += 1
+        if remove:
+            os.remove(filepath)
+    return migrated
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Manage the raw map end dump archive.')
+    parser.add_argument('--directory', default='matchresults', help='The matchresults directory.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    migrate_parser = subparsers.add_parser('migrate', help='Move raw_*.json files into the archive.')
+    migrate_parser.add_argument('--remove', action='store_true', help='Delete each raw file once it is archived.')
+    subparsers.add_parser('list', help='List archived dumps.')
+    show_parser = subparsers.add_parser('show', help='Print one archived dump.')
+    show_parser.add_argument('key')
+    args = parser.parse_args(argv)
+
+    archive = RawArchive(os.path.join(args.directory, 'raw'))
+    if args.command == 'migrate':
+        print(f"Archived {migrate_raw_files(args.directory, archive, remove=args.remove)} raw files.")
+    elif args.command == 'list':
+        for key in archive.keys():
+            print(key)
+    elif args.command == 'show':
+        data = archive.read(args.key)
+        if data is None:
+            sys.exit(f"No archived dump {args.key}")
+        print(json.dumps(data, indent=4))
+
+
+if __name__ == '__main__':
+    main()
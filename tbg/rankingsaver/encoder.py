@@ -0,0 +1,120 @@
+"""
+The encoder module serializes results for the disk and the wire.
+
+Files that only programs read (the day journal, the standings index, live standings, push events, raw dumps)
+are written compact, using orjson when it is installed. Human-facing exports are indented exactly like
+json.dumps(..., indent=4), so existing day files and their readers see no difference.
+"""
+import json
+from json.encoder import encode_basestring, encode_basestring_ascii
+
+from .model import RacerResult, RoundResult, TeamResult
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _model_to_dict(obj):
+    if isinstance(obj, (RoundResult, RacerResult, TeamResult)):
+        return obj.to_dict()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def _string(value, encode=encode_basestring) -> str:
+    return 'null' if value is None else encode(value)
+
+
+def _compact_racer(racer: RacerResult) -> str:
+    if racer.best_time is None:
+        return '{"Nick":%s,"Rank":%d}' % (_string(racer.nick), racer.rank)
+    return '{"Nick":%s,"Rank":%d,"BestTime":%s}' % (_string(racer.nick), racer.rank, _string(racer.best_time))
+
+
+def _compact_team(team: TeamResult) -> str:
+    text = '{"Team":%s,"Rank":%d,"Points":%d' % (_string(team.name), team.rank, team.points)
+    if team.best_time is not None:
+        text += ',"BestTime":%s' % _string(team.best_time)
+    if team.top_average is not None:
+        text += ',"TopAverage":%s' % _string(team.top_average)
+    return text + '}'
+
+
+def _compact_round(round_result: RoundResult) -> str:
+    text = '{"TrackName":%s,"RacedAtUtc":%s,"RacerResults":[%s]' % (
+        _string(round_result.track_name), _string(round_result.raced_at_utc),
+        ','.join([_compact_racer(racer) for racer in round_result.racer_results]))
+    if round_result.team_results is not None:
+        text += ',"TeamResults":[%s]' % ','.join([_compact_team(team) for team in round_result.team_results])
+    return text + '}'
+
+
+def _indented_racer(racer: RacerResult, prefix: str) -> str:
+    inner = prefix + '    '
+    text = '%s{\n%s"Nick": %s,\n%s"Rank": %d' % (
+        prefix, inner, _string(racer.nick, encode_basestring_ascii), inner, racer.rank)
+    if racer.best_time is not None:
+        text += ',\n%s"BestTime": %s' % (inner, encode_basestring_ascii(racer.best_time))
+    return text + '\n' + prefix + '}'
+
+
+def _indented_team(team: TeamResult, prefix: str) -> str:
+    inner = prefix + '    '
+    text = '%s{\n%s"Team": %s,\n%s"Rank": %d,\n%s"Points": %d' % (
+        prefix, inner, _string(team.name, encode_basestring_ascii), inner, team.rank, inner, team.points)
+    if team.best_time is not None:
+        text += ',\n%s"BestTime": %s' % (inner, encode_basestring_ascii(team.best_time))
+    if team.top_average is not None:
+        text += ',\n%s"TopAverage": %s' % (inner, encode_basestring_ascii(team.top_average))
+    return text + '\n' + prefix + '}'
+
+
+def _indented_list(items: list, indent_item, inner: str) -> str:
+    if not items:
+        return '[]'
+    return '[\n' + ',\n'.join([indent_item(item, inner + '    ') for item in items]) + '\n' + inner + ']'
+
+
+def _indented_round(round_result: RoundResult, prefix: str) -> str:
+    inner = prefix + '    '
+    text = '%s{\n%s"TrackName": %s,\n%s"RacedAtUtc": %s,\n%s"RacerResults": %s' % (
+        prefix, inner, _string(round_result.track_name, encode_basestring_ascii),
+        inner, _string(round_result.raced_at_utc, encode_basestring_ascii),
+        inner, _indented_list(round_result.racer_results, _indented_racer, inner))
+    if round_result.team_results is not None:
+        text += ',\n%s"TeamResults": %s' % (inner, _indented_list(round_result.team_results, _indented_team, inner))
+    return text + '\n' + prefix + '}'
+
+
+def dumps(obj, indent: bool = False, prefix: str = '') -> str:
+    """
+    Serializes obj, which may be or contain RoundResults and RacerResults.
+
+    Parameters:
+    indent (bool): Indent like json.dumps(obj, indent=4), for human-facing exports. Otherwise the output is compact.
+    prefix (str): With indent, a prefix for every line, e.g. to nest the output inside another document.
+
+    Returns:
+    str: The JSON document.
+    """
+    if indent:
+        if isinstance(obj, RoundResult):
+            return _indented_round(obj, prefix)
+        text = json.dumps(obj, indent=4, default=_model_to_dict)
+        return '\n'.join(prefix + line for line in text.split('\n')) if prefix else text
+
+    if orjson is not None:
+        # Non-string keys (e.g. a null Nick in the standings) are written as json.dumps would.
+        return orjson.dumps(obj, default=_model_to_dict, option=orjson.OPT_NON_STR_KEYS).decode("utf-8")
+    if isinstance(obj, RoundResult):
+        return _compact_round(obj)
+    return json.dumps(obj, separators=(',', ':'), ensure_ascii=False, default=_model_to_dict)
+
+
+def day_file_fragment(round_result) -> str:
+    """
+    Serializes a RoundResult exactly as it appears inside a day file's RoundResults list, so that day files can be
+    put together from one fragment per round.
+    """
+    return dumps(round_result, indent=True, prefix='        ')
@@ -1,58 +1,838 @@
 import asyncio
+import cProfile
+import glob
 import json
+import logging
 import os
+import pstats
+import re
+import sys
+import threading
+import time
+from bisect import bisect_right
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import AsyncExitStack, asynccontextmanager
 from datetime import datetime
+from typing import List, Optional, Tuple
+
+from . import metrics
+from .archive import RawArchive
+from .encoder import day_file_fragment, dumps
+from .helpers import process_lock, tail_lines
+from .rendering import player_team_id
+from .splits import SplitsArchive, encode_splits
+from .standings import StandingsIndex
+from .store import ResultStore
+
+logger = logging.getLogger(__name__)
+
+# Each file (or set of files) in the matchresults directory has its own lock, see file_lock.
+_file_locks = {}
+
+# All blocking disk work runs on these writer threads, so that the PyPlanet event loop never waits on the disk.
+# Callers hold the lock of the file they are writing while they wait, so writes to any one file stay in order
+# while writes to different files (e.g. the raw dump and the day journal) go to disk side by side.
+IO_WORKERS = 4
+io_executor = ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix='rankingsaver-io')
+
+# Enqueue-to-durable latency of every job run on io_executor.
+_io_latency = {
+    'count': 0,
+    'total': 0.0,
+    'max': 0.0,
+    'last': 0.0,
+}
+
+# While an EndMap is being profiled, the profile of every job run on io_executor (see start_io_profile).
+_io_profiles = None
+
+# Days whose journal has been appended to since their day file was last exported.
+_pending_exports = set()
+
+STANDINGS_INDEX_PATH = "matchresults/standings.json"
+STANDINGS_EXPORT_PATH = "matchresults/standings_export.json"
+
+RAW_ARCHIVE_PATH = "matchresults/raw"
+SPLITS_ARCHIVE_PATH = "matchresults/splits"
+LIVE_STANDINGS_PATH = "matchresults/live.json"
+RESULT_STORE_PATH = "matchresults/results.sqlite3"
+METRICS_PATH = "matchresults/metrics.prom"
+STATE_PATH = "matchresults/state.json"
+
+# Raw map end dumps. Only ever touched from io_executor, under file_lock(RAW_ARCHIVE_PATH).
+raw_archive = RawArchive(RAW_ARCHIVE_PATH)
+
+# Checkpoint splits, when they are being recorded. Only ever touched from io_executor, under file_lock(SPLITS_ARCHIVE_PATH).
+splits_archive = SplitsArchive(SPLITS_ARCHIVE_PATH)
+
+# The overall standings, loaded on first use. Only ever touched from io_executor, under file_lock(STANDINGS_INDEX_PATH).
+_standings = None
+_standings_unsaved = 0
+_standings_pending = False
+
+# The standings index is only rewritten every this many rounds; rounds counted since are replayed from the journals.
+STANDINGS_SNAPSHOT_ROUNDS = 25
+
+# This server's name, when several servers share the matchresults directory (see set_server_id).
+server_id = None
+
+# The optional SQLite copy of the results, see open_result_store. Only ever touched from io_executor,
+# under file_lock(RESULT_STORE_PATH).
+result_store = None
+
+
+def file_lock(filepath: str) -> asyncio.Lock:
+    """
+    file_lock returns the lock that MUST be held if you wish to work with the given file in the matchresults directory.
+    When holding more than one, take a day journal's lock before the standings lock.
+    """
+    lock = _file_locks.get(filepath)
+    if lock is None:
+        lock = _file_locks[filepath] = asyncio.Lock()
+    return lock
+
+
+@asynccontextmanager
+async def locked(*filepaths: str):
+    """
+    Holds the locks of the given files (taken in the order given), recording how long it waited for them.
+    """
+    async with AsyncExitStack() as stack:
+        with metrics.span('lock_wait'):
+            for filepath in filepaths:
+                await stack.enter_async_context(file_lock(filepath))
+        yield
+
+
+def set_server_id(new_server_id: Optional[str]):
+    """
+    set_server_id names this server, for when several servers (e.g. parallel heats) share the matchresults directory.
+    A named server keeps its own day journals, live standings, metrics and state; the day files and standings
+    combine every server's rounds. None keeps the single-server file names.
+    """
+    global server_id
+    server_id = re.sub(r'[^A-Za-z0-9_-]', '_', new_server_id) if new_server_id else None
+
+
+def _server_path(filepath: str) -> str:
+    """
+    Returns this server's own copy of a per-server file, e.g. matchresults/live.heat2.json.
+    """
+    if server_id is None:
+        return filepath
+    root, extension = os.path.splitext(filepath)
+    return f"{root}.{server_id}{extension}"
+
+
+async def run_io(func, *args):
+    """
+    run_io runs a blocking function on the I/O executor and waits for it to complete,
+    recording how long it took from being enqueued to being durable on disk.
+    """
+    enqueued = time.perf_counter()
+    if _io_profiles is not None:
+        func, args = _run_profiled, (_io_profiles, func) + args
+    try:
+        return await asyncio.get_event_loop().run_in_executor(io_executor, func, *args)
+    finally:
+        latency = time.perf_counter() - enqueued
+        _io_latency['count'] += 1
+        _io_latency['total'] += latency
+        _io_latency['max'] = max(_io_latency['max'], latency)
+        _io_latency['last'] = latency
+        metrics.observe('io', latency)
+
+
+def _run_profiled(profiles: list, func, *args):
+    # A profiler only sees the thread it was enabled on, so each job gets its own.
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        # Another profiler is already on (from Python 3.12 only one can be); the job must run regardless.
+        return func(*args)
+    try:
+        return func(*args)
+    finally:
+        profiler.disable()
+        profiles.append(profiler)
+
+
+def start_io_profile():
+    """
+    start_io_profile profiles every job run on the I/O executor from now on, until stop_io_profile.
+    From Python 3.12 the event loop's profiler already sees every thread, so there is nothing to do.
+    """
+    global _io_profiles
+    if sys.version_info < (3, 12):
+        _io_profiles = []
+
+
+def stop_io_profile() -> list:
+    """
+    stop_io_profile stops profiling the I/O executor.
+
+    Returns:
+    list: The cProfile.Profile of every job run since start_io_profile.
+    """
+    global _io_profiles
+    profiles, _io_profiles = _io_profiles or [], None
+    return profiles
+
+
+async def dump_profile(filepath: str, profilers: list):
+    """
+    dump_profile merges the given profiles (e.g. the event loop's and the I/O executor's) into one pstats file.
+    """
+    await run_io(_dump_profile, filepath, profilers)
+
+
+def _dump_profile(filepath: str, profilers: list):
+    stats = pstats.Stats(profilers[0])
+    for profiler in profilers[1:]:
+        stats.add(profiler)
+    stats.dump_stats(filepath)
+
+
+def io_latency_stats() -> dict:
+    """
+    io_latency_stats returns the enqueue-to-durable latency of disk writes, in milliseconds.
+    """
+    count = _io_latency['count']
+    return {
+        'count': count,
+        'mean_ms': (_io_latency['total'] / count * 1000) if count else 0.0,
+        'max_ms': _io_latency['max'] * 1000,
+        'last_ms': _io_latency['last'] * 1000,
+    }
+
+
+def _write_durable(filepath: str, content: str, mode: str = 'w'):
+    """
+    Writes content to filepath and waits for it to reach the disk.
+    """
+    with open(filepath, mode, encoding="utf-8") as output_file:
+        output_file.write(content)
+        output_file.flush()
+        os.fsync(output_file.fileno())
+
+
+def _replace_file(filepath: str, content: str, durable: bool = True):
+    """
+    Writes content to the side and swaps it in, so that readers never see a half-written file.
+    """
+    if durable:
+        _write_durable(f"{filepath}.tmp", content)
+    else:
+        with open(f"{filepath}.tmp", 'w', encoding="utf-8") as output_file:
+            output_file.write(content)
+    os.replace(f"{filepath}.tmp", filepath)
+
+
+def _today() -> str:
+    return datetime.today().strftime('%Y-%m-%d')
+
+
+def _matchresult_path(day: str) -> str:
+    """
+    Path of the Scorematron-compatible day file ({"RoundResults": [...]}).
+    """
+    return f"matchresults/{day}.json"
+
+
+def _journal_path(day: str) -> str:
+    """
+    Path of this server's append-only day journal (one RoundResult JSON document per line).
+    """
+    return _server_path(f"matchresults/{day}.jsonl")
+
+
+def _shard_paths(day: str) -> List[str]:
+    """
+    Paths of every server's journal for a day, including the single-server journal.
+    """
+    paths = glob.glob(f"matchresults/{day}.*.jsonl")
+    if os.path.exists(f"matchresults/{day}.jsonl"):
+        paths.append(f"matchresults/{day}.jsonl")
+    return sorted(paths)
+
+
+def _read_shard(shard_path: str, offset: int = 0) -> Tuple[List[Tuple[int, dict]], int]:
+    """
+    Reads the whole lines appended to a day journal since offset. A trailing partial line is left for next time,
+    as it may still be being written.
+
+    Returns:
+    tuple: The (offset, RoundResult) of each line read, and the offset to carry on from.
+    """
+    with open(shard_path, 'rb') as shard_file:
+        shard_file.seek(offset)
+        data = shard_file.read()
+
+    entries = []
+    end = data.rfind(b'\n') + 1
+    line_offset = offset
+    for line in data[:end].split(b'\n')[:-1]:
+        if line.strip():
+            try:
+                entries.append((line_offset, json.loads(line)))
+            except ValueError:
+                # A torn line is what an interrupted append leaves behind; skip it rather than losing the whole day.
+                logger.warning("Skipping unreadable line at byte %d of %s", line_offset, shard_path)
+        line_offset += len(line) + 1
+    return entries, offset + end
+
+
+def _merge_key(shard_path: str, line_offset: int, round_result: dict) -> tuple:
+    # Rounds from every server are merged in the order they were raced.
+    return round_result.get('RacedAtUtc') or '', os.path.basename(shard_path), line_offset
+
+
+def _migrate_day_file(day: str):
+    """
+    Seeds a day's journal from an existing (pre-journal) day file, so that rounds
+    saved before the journal existed are not lost on the next export.
+    """
+    matchresult_path = _matchresult_path(day)
+    if _shard_paths(day) or not os.path.exists(matchresult_path):
+        return
+
+    with open(matchresult_path, 'r', encoding="utf-8") as match_file:
+        data = json.load(match_file)
+
+    # Always the single-server journal, so that servers racing to migrate the same day write the same file.
+    _write_durable(f"matchresults/{day}.jsonl", ''.join(dumps(r) + '\n' for r in data.get('RoundResults', [])))
+
+
+def _file_stat(filepath: str) -> Optional[tuple]:
+    try:
+        stat = os.stat(filepath)
+    except FileNotFoundError:
+        return None
+    return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+
+def _read_tail(filepath: str, end: int, length: int = 64) -> bytes:
+    """
+    Returns the bytes of a file just before end, to recognise it again later.
+    """
+    with open(filepath, 'rb') as input_file:
+        input_file.seek(max(0, end - length))
+        return input_file.read(min(end, length))
+
+
+class DayCache:
+    """
+    Keeps one day's RoundResults from every server's journal resident, in the order they were raced, along with
+    each round's already-serialized day file fragment, so that exporting the day file only has to splice strings
+    together.
+
+    Journals are only ever appended to, so a refresh reads just what each server has added since the last one.
+    Each journal's (mtime, size, inode) is remembered along with the bytes just before the last offset read, and the
+    cache is rebuilt if a journal is rewritten (it disappears, shrinks, is replaced, changes without growing, or no
+    longer ends the way it did), and when the day changes.
+    """
+
+    def __init__(self):
+        self._reset(None)
+
+    def _reset(self, day: Optional[str]):
+        self.day = day
+        self.keys = []
+        self.round_results = []
+        self.fragments = []
+        self.offsets = {}
+        self.stats = {}
+        self.tails = {}
+
+    def _remember(self, shard_path: str, stat: Optional[tuple]):
+        self.stats[shard_path] = stat
+        self.tails[shard_path] = _read_tail(shard_path, self.offsets[shard_path])
+
+    def _rewritten(self, shard_path: str, stat: Optional[tuple]) -> bool:
+        known = self.stats.get(shard_path)
+        if stat == known:
+            return False
+        if stat is None or known is None:
+            return True
+        _, size, inode = stat
+        if inode != known[2] or size < self.offsets[shard_path] or size == known[1]:
+            return True
+        # It grew, which is what an append looks like; make sure what was already read is still there.
+        return _read_tail(shard_path, self.offsets[shard_path]) != self.tails[shard_path]
+
+    def _insert(self, key: tuple, round_result: dict):
+        index = bisect_right(self.keys, key)
+        self.keys.insert(index, key)
+        self.round_results.insert(index, round_result)
+        self.fragments.insert(index, day_file_fragment(round_result))
+
+    def refresh(self, day: str):
+        """
+        Brings the cache up to date with every server's journal for the day.
+        """
+        stats = {shard_path: _file_stat(shard_path) for shard_path in _shard_paths(day)}
+        if self.day != day or any(self._rewritten(path, stats.get(path)) for path in self.offsets):
+            self._reset(day)
+
+        for shard_path, stat in stats.items():
+            if stat is None or (shard_path in self.stats and stat == self.stats[shard_path]):
+                continue
+            entries, self.offsets[shard_path] = _read_shard(shard_path, self.offsets.get(shard_path, 0))
+            for line_offset, round_result in entries:
+                self._insert(_merge_key(shard_path, line_offset, round_result), round_result)
+            self._remember(shard_path, stat)
+
+    def append(self, shard_path: str, line_offset: int, end: int, round_result: dict):
+        """
+        Adds a round that has just been appended to this server's journal, without reading it back.
+        """
+        self._insert(_merge_key(shard_path, line_offset, round_result), round_result)
+        self.offsets[shard_path] = end
+        self._remember(shard_path, _file_stat(shard_path))
+
+    def render(self) -> str:
+        """
+        Returns the day file, identical to json.dumps({"RoundResults": [...]}, indent=4).
+        """
+        if not self.fragments:
+            return '{\n    "RoundResults": []\n}'
+        return '{\n    "RoundResults": [\n' + ',\n'.join(self.fragments) + '\n    ]\n}'
+
+
+# Caches of the most recent days, by day. Each cache is only ever touched from io_executor, under its day journal's
+# lock; the dict itself is shared by every day, so it has a lock of its own.
+_day_caches = {}
+_day_caches_lock = threading.Lock()
+
+
+def _day_cache(day: str) -> DayCache:
+    with _day_caches_lock:
+        cache = _day_caches.get(day)
+        if cache is None:
+            cache = _day_caches[day] = DayCache()
+            # Yesterday is kept around for its final export after midnight; anything older can go.
+            for old_day in sorted(_day_caches)[:-2]:
+                _day_caches.pop(old_day, None)
+        return cache
+
+
+def recorded_days() -> List[str]:
+    """
+    recorded_days returns every day (YYYY-MM-DD) that has a journal or day file, oldest first.
+    """
+    days = set()
+    for filepath in glob.glob("matchresults/*.json*"):
+        match = re.fullmatch(r'(\d{4}-\d{2}-\d{2})(\.[A-Za-z0-9_-]+)?\.jsonl?', os.path.basename(filepath))
+        if match:
+            days.add(match.group(1))
+    return sorted(days)
+
+
+def read_matchresults(day: Optional[str] = None) -> List[dict]:
+    """
+    read_matchresults returns every RoundResult recorded for the given day (default: today), from every server.
+    The journals are preferred; days recorded before the journal existed are read from the day file.
+    """
+    if day is None:
+        day = _today()
+
+    shard_paths = _shard_paths(day)
+    if shard_paths:
+        entries = []
+        for shard_path in shard_paths:
+            for line_offset, round_result in _read_shard(shard_path)[0]:
+                entries.append((_merge_key(shard_path, line_offset, round_result), round_result))
+        entries.sort(key=lambda entry: entry[0])
+        return [round_result for _, round_result in entries]
+
+    if os.path.exists(_matchresult_path(day)):
+        with open(_matchresult_path(day), 'r', encoding="utf-8") as match_file:
+            return json.load(match_file).get('RoundResults', [])
+
+    return []
+
+
+async def update_matchresult(round_result: dict, day: Optional[str] = None):
+    """
+    update_matchresult appends the given round_result to a day's matchresult journal (default: today's).
+    The Scorematron day file is produced from the journal by export_matchresult.
+    """
+    if day is None:
+        day = _today()
+    with metrics.span('update_matchresult'):
+        async with locked(_journal_path(day), STANDINGS_INDEX_PATH):
+            await run_io(_append_matchresult, day, round_result)
+            _pending_exports.add(day)
+
+        global _standings_pending
+        _standings_pending = True
+
+        await _store_result(ResultStore.add_round, round_result)
+
+
+def _append_matchresult(day: str, round_result: dict):
+    # Every server appends and counts its rounds under the same lock, so that a first-time standings build from
+    # history can never see a round that its server hasn't counted yet, and no server overwrites another's count.
+    with process_lock(STANDINGS_INDEX_PATH):
+        _migrate_day_file(day)
+        day_cache = _day_cache(day)
+        day_cache.refresh(day)
+        # Catch the standings up before the journal grows, so that only this round is left to count.
+        standings = _load_standings()
+
+        journal_path = _journal_path(day)
+        with metrics.span('update_matchresult.encode'):
+            line = dumps(round_result) + '\n'
+        line_offset = os.path.getsize(journal_path) if os.path.exists(journal_path) else 0
+        if line_offset > day_cache.offsets.get(journal_path, 0):
+            # An interrupted append left a partial line behind; end it, so that this round gets a line of its own.
+            line = '\n' + line
+            line_offset += 1
+        # Appending is O(1) regardless of how many rounds have already been played today.
+        with metrics.span('update_matchresult.write'):
+            _write_durable(journal_path, line, mode='a')
+        end = os.path.getsize(journal_path)
+        day_cache.append(journal_path, line_offset, end, round_result)
+
+        with metrics.span('update_matchresult.standings'):
+            standings.add_round(round_result)
+            standings.journals[os.path.basename(journal_path)] = end
+            _standings_counted(1)
+
+
+async def recent_race_times(day: str, count: int) -> set:
+    """
+    recent_race_times returns the RacedAtUtc of the last rounds in each of a day's journals, reading only
+    the end of them.
+    """
+    async with locked(_journal_path(day)):
+        return await run_io(_recent_race_times, day, count)
+
+
+def _recent_race_times(day: str, count: int) -> set:
+    _migrate_day_file(day)
+    raced_at = set()
+    for shard_path in _shard_paths(day):
+        for line in tail_lines(shard_path, count):
+            try:
+                raced_at.add(json.loads(line).get('RacedAtUtc'))
+            except ValueError:
+                continue
+    return raced_at
+
+
+def _load_standings() -> StandingsIndex:
+    """
+    Returns the standings, caught up with every round journaled so far (by any server).
+    Only call this while holding process_lock(STANDINGS_INDEX_PATH).
+    """
+    global _standings
+    if _standings is None:
+        if os.path.exists(STANDINGS_INDEX_PATH):
+            with open(STANDINGS_INDEX_PATH, 'r', encoding="utf-8") as index_file:
+                data = json.load(index_file)
+            _standings = StandingsIndex(data)
+            if 'Journals' not in data:
+                # Indexes from before snapshots were written after every round, so they counted everything journaled.
+                _standings.journals = {os.path.basename(path): os.path.getsize(path) for path in _journal_paths()}
+        else:
+            # First run with standings: journal any day file from before the journals, then count every journal.
+            for day in recorded_days():
+                _migrate_day_file(day)
+            _standings = StandingsIndex()
+    _catch_up_standings(_standings)
+    return _standings
+
+
+def _journal_paths() -> List[str]:
+    """
+    Paths of every day journal, from every server.
+    """
+    return sorted(path for path in glob.glob("matchresults/*.jsonl")
+                  if re.fullmatch(r'\d{4}-\d{2}-\d{2}(\.[A-Za-z0-9_-]+)?\.jsonl', os.path.basename(path)))
+
+
+def _catch_up_standings(standings: StandingsIndex):
+    """
+    Counts every round journaled after the offsets the standings have counted up to: rounds since the last snapshot,
+    other servers' rounds, and rounds whose server stopped between journaling them and counting them.
+    """
+    counted = 0
+    for journal_path in _journal_paths():
+        name = os.path.basename(journal_path)
+        offset = standings.journals.get(name, 0)
+        if os.path.getsize(journal_path) > offset:
+            entries, standings.journals[name] = _read_shard(journal_path, offset)
+            for _, round_result in entries:
+                standings.add_round(round_result)
+            counted += len(entries)
+    if counted:
+        _standings_counted(counted)
+
+
+def _standings_counted(rounds: int):
+    # Snapshot the standings every so often, so that catching up on start-up stays short.
+    global _standings_unsaved
+    _standings_unsaved += rounds
+    if _standings_unsaved >= STANDINGS_SNAPSHOT_ROUNDS:
+        _save_standings()
+
+
+def _save_standings():
+    global _standings_unsaved
+    with metrics.span('standings.snapshot'):
+        _replace_file(STANDINGS_INDEX_PATH, dumps(_standings.to_dict()))
+    _standings_unsaved = 0
+
+
+async def standings_table() -> List[dict]:
+    """
+    standings_table returns the overall tournament table, most points first.
+    """
+    async with locked(STANDINGS_INDEX_PATH):
+        return await run_io(_standings_table)
+
+
+def _standings_table() -> List[dict]:
+    with process_lock(STANDINGS_INDEX_PATH):
+        return _load_standings().table()
+
+
+async def save_standings():
+    """
+    save_standings catches the standings up with every journal and snapshots them, if that counted anything new.
+    """
+    async with locked(STANDINGS_INDEX_PATH):
+        await run_io(_save_standings_if_unsaved)
+
+
+def _save_standings_if_unsaved():
+    with process_lock(STANDINGS_INDEX_PATH):
+        _load_standings()
+        if _standings_unsaved:
+            _save_standings()
+
+
+async def export_standings():
+    """
+    export_standings writes the overall tournament table, and the team table if teams have played, to its export file.
+    """
+    global _standings_pending
+    _standings_pending = False
+    async with locked(STANDINGS_INDEX_PATH):
+        await run_io(_export_standings)
+
+
+def _export_standings():
+    with process_lock(STANDINGS_INDEX_PATH):
+        standings = _load_standings()
+        export = {"Standings": standings.table()}
+        if standings.teams:
+            export["TeamStandings"] = standings.team_table()
+    with process_lock(STANDINGS_EXPORT_PATH):
+        _replace_file(STANDINGS_EXPORT_PATH, dumps(export, indent=True))
+
+
+async def export_matchresult(day: Optional[str] = None):
+    """
+    export_matchresult compacts a day's journal (default: today) into the
+    Scorematron-compatible {"RoundResults": [...]} day file.
+    """
+    if day is None:
+        day = _today()
+
+    async with locked(_journal_path(day)):
+        await run_io(_export_matchresult, day)
+        _pending_exports.discard(day)
+
+
+def _export_matchresult(day: str):
+    # Any server may export the combined day file; whoever goes last has seen every round before it.
+    with process_lock(_matchresult_path(day)):
+        _migrate_day_file(day)
+        day_cache = _day_cache(day)
+        day_cache.refresh(day)
+        _replace_file(_matchresult_path(day), day_cache.render())
+
+
+async def export_pending_matchresults():
+    """
+    export_pending_matchresults exports every day file whose journal has changed since it was last exported,
+    and the standings if they have changed.
+    """
+    for day in sorted(_pending_exports):
+        await export_matchresult(day)
+    if _standings_pending:
+        await export_standings()
+
+
+async def write_live_standings(live_standings: dict):
+    """
+    write_live_standings overwrites the live standings snapshot read by the Scorematron overlay.
+    """
+    # No fsync, as the next snapshot is only seconds away.
+    async with locked(_server_path(LIVE_STANDINGS_PATH)):
+        await run_io(_replace_file, _server_path(LIVE_STANDINGS_PATH), dumps(live_standings), False)
+
+
+async def write_state(state: dict):
+    """
+    write_state checkpoints the app's tracking state, so that it survives a controller restart.
+    """
+    async with locked(_server_path(STATE_PATH)):
+        await run_io(_write_state, state)
+
+
+def _write_state(state: dict):
+    os.makedirs(os.path.dirname(STATE_PATH), exist_ok=True)
+    _replace_file(_server_path(STATE_PATH), dumps(state))
+
+
+async def read_state() -> dict:
+    """
+    read_state returns the last checkpointed tracking state, or an empty dict if there is none.
+    """
+    async with locked(_server_path(STATE_PATH)):
+        return await run_io(_read_state)
+
+
+def _read_state() -> dict:
+    try:
+        with open(_server_path(STATE_PATH), 'r', encoding="utf-8") as state_file:
+            return json.load(state_file)
+    except FileNotFoundError:
+        return {}
+    except ValueError:
+        logger.warning("Ignoring unreadable state checkpoint %s", _server_path(STATE_PATH))
+        return {}
+
+
+async def write_metrics():
+    """
+    write_metrics writes the pipeline timings to matchresults/metrics.prom, in the Prometheus text format.
+    """
+    async with locked(_server_path(METRICS_PATH)):
+        await run_io(_write_metrics, metrics.prometheus_text())
+
+
+def _write_metrics(text: str):
+    # The export loop runs from start-up, before //tbg start has created the matchresults directory.
+    os.makedirs(os.path.dirname(METRICS_PATH), exist_ok=True)
+    # No fsync, as the next write is only seconds away.
+    _replace_file(_server_path(METRICS_PATH), text, False)
+
+
+async def dump_mapend_raw(players: dict, teams: dict, map_name: Optional[str] = None, timestr: Optional[str] = None,
+                          record_splits: bool = False):
+    """
+    dump_mapend_raw appends the raw map end information to the raw dump archive, keyed by the time it was taken
+    (default: now). With record_splits, everyone's best-run checkpoint times go to the splits archive too.
+    """
+    if timestr is None:
+        timestr = datetime.utcnow().isoformat()
+    with metrics.span('dump_mapend_raw'):
+        async with locked(RAW_ARCHIVE_PATH):
+            with metrics.span('dump_mapend_raw.collect'):
+                data = {
+                    "MapName": map_name,
+                    "Players": [],
+                }
+                if server_id is not None:
+                    data["Server"] = server_id
+                if teams:
+                    data["Teams"] = [{'id': team.get('id'), 'name': team.get('name')} for team in teams]
+                for player in players:
+                    player_data = {
+                        'best_race_time': player.get('best_race_time', 'UNKNOWN'),
+                        'best_lap_time': player.get('best_lap_time', 'UNKNOWN'),
+                    }
+                    if player.get('player', None) is not None:
+                        player_data['nickname'] = player['player'].nickname
+                        player_data['login'] = player['player'].login
+                        if teams:
+                            player_data['team_id'] = player_team_id(player)
+                    data.get('Players').append(player_data)
+
+            # Write the appropriate raw data to disk.
+            await run_io(_archive_raw_dump, timestr, data)
+
+        if record_splits:
+            async with locked(SPLITS_ARCHIVE_PATH):
+                with metrics.span('dump_mapend_raw.splits'):
+                    block = encode_splits(players)
+                await run_io(_archive_splits, timestr, block)
+
+        await _store_result(ResultStore.add_raw_dump, timestr, data)
+
+
+def _archive_raw_dump(key: str, data: dict):
+    # Servers sharing the matchresults directory share the archive too.
+    with process_lock(RAW_ARCHIVE_PATH):
+        raw_archive.append(key, data)
+
+
+def _archive_splits(key: str, block: bytes):
+    with process_lock(SPLITS_ARCHIVE_PATH):
+        splits_archive.append(key, block)
+
+
+async def open_result_store(path: str = RESULT_STORE_PATH):
+    """
+    open_result_store starts copying every round and raw dump into a SQLite database.
+    A new database first imports every round recorded so far.
+    """
+    global result_store
+    async with locked(RESULT_STORE_PATH):
+        if result_store is None:
+            result_store = await run_io(_open_result_store, path)
+
+
+def _open_result_store(path: str) -> ResultStore:
+    # The store can be turned on before //tbg start has created the matchresults directory.
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    store = ResultStore(path)
+    if not store.imported:
+        # A new database starts out with every round already recorded, so that history lookups cover past events.
+        imported = store.import_rounds(
+            round_result for day in recorded_days() for round_result in read_matchresults(day))
+        logger.info("Imported %d recorded rounds into %s", imported, path)
+    return store
+
+
+async def close_result_store():
+    """
+    close_result_store stops copying results into SQLite.
+    """
+    global result_store
+    async with locked(RESULT_STORE_PATH):
+        if result_store is not None:
+            await run_io(result_store.close)
+            result_store = None
+
+
+async def _store_result(method, *args):
+    """
+    Writes to the SQLite store, if it is open. The JSON files are the source of truth,
+    so a failure here is logged rather than failing the save.
+    """
+    if result_store is None:
+        return
+    try:
+        async with locked(RESULT_STORE_PATH):
+            if result_store is not None:
+                await run_io(method, result_store, *args)
+    except Exception as e:
+        logger.exception(e)
+
+
+async def query_result_store(method, *args):
+    """
+    query_result_store runs a ResultStore query (e.g. ResultStore.best_times) off the event loop.
+    Returns None if the store is not open.
+    """
+    async with locked(RESULT_STORE_PATH):
+        if result_store is None:
+            return None
+        return await run_io(method, result_store, *args)
 
-# This mutex MUST be held if you wish to work with the matchresults directory.
-matchfile_mutex = asyncio.Lock()
-
-async def update_matchresult(round_result: dict):
-    """
-    update_matchresult updates today's matchresult file with the given round_result.
-    """
-    today = datetime.today().strftime('%Y-%m-%d')
-    filepath = f"matchresults/{today}.json"
-    # Open today's file.
-    async with matchfile_mutex:
-        data = None
-        if os.path.exists(filepath):
-            with open(filepath, 'r', encoding="utf-8") as match_file:
-                data = json.load(match_file)
-
-        if data is None:
-            # Create new basic data structure.
-            data = {
-                "RoundResults": [],
-            }
-
-        data['RoundResults'].append(round_result)
-
-        # Overwrite today's matchresults file.
-        with open(filepath, 'w+', encoding="utf-8") as match_file:
-            match_file.write(json.dumps(data, indent=4))
-
-async def dump_mapend_raw(players: dict, teams: dict):
-    """
-    dump_mapend_raw writes the raw map end information to a JSON file.
-    """
-    timestr = datetime.utcnow().isoformat()
-    filepath = f"matchresults/raw_{timestr}.json"
-    # Open the appropriate raw data file.
-    async with matchfile_mutex:
-        data = {
-            "Players": [],
-        }
-        for player in players:
-            player_data = {
-                'best_race_time': player.get('best_race_time', 'UNKNOWN'),
-                'best_lap_time': player.get('best_lap_time', 'UNKNOWN'),
-            }
-            if player.get('player', None) is not None:
-                player_data['nickname'] = player['player'].nickname
-                player_data['login'] = player['player'].login
-            data.get('Players').append(player_data)
-
-
-        # Write the appropriate raw data to disk.
-        with open(filepath, 'w+', encoding="utf-8") as match_file:
-            match_file.write(json.dumps(data, indent=4))
\ No newline at end of file
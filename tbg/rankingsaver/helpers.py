@@ -1,7 +1,72 @@
 """
 The helpers module provides useful utility functions to the main application code.
 """
-import math
+import os
+import re
+from contextlib import contextmanager
+from functools import lru_cache
+from typing import List, Sequence
+
+try:
+    from pyplanet.utils.style import STRIP_ALL, style_strip
+except ImportError:  # pragma: no cover
+    # Offline tools can run without PyPlanet; this is the expression PyPlanet's style_strip uses for STRIP_ALL.
+    STRIP_ALL = None
+    _STRIP_ALL_REGEX = re.compile(
+        r'((?<!\$)\$[wnoitsgz<>]|(?<!\$)\$[lh]\[.+\]|(?<!\$)\$[lh]|(?<!\$)\$[0-9a-f]{1,3}|(?<!\$)\$[f-y]{1})+',
+        flags=re.IGNORECASE)
+
+    def style_strip(text, *strip_methods):
+        return _STRIP_ALL_REGEX.sub('', text).replace('$$', '$')
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    # Windows: servers can't share a matchresults directory there.
+    fcntl = None
+
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None
+
+# How many distinct styled strings (nicknames and track names) strip_styles remembers.
+STRIP_CACHE_SIZE = 4096
+
+# Columns at least this long are formatted with NumPy, when it is available.
+NUMPY_FORMAT_THRESHOLD = 2000
+
+
+@lru_cache(maxsize=STRIP_CACHE_SIZE)
+def strip_styles(text: str) -> str:
+    """
+    Strips all Maniaplanet styling from a nickname or track name.
+    Results are cached, as the same handful of nicknames come round on every map.
+
+    Parameters:
+    text (str): A styled string.
+
+    Returns:
+    str: The string with all styling removed.
+    """
+    return style_strip(text, STRIP_ALL)
+
+
+def strip_cache_stats() -> dict:
+    """
+    Returns the hit/miss counters of the strip_styles cache.
+
+    Returns:
+    dict: hits, misses, size and maxsize of the cache.
+    """
+    info = strip_styles.cache_info()
+    return {
+        'hits': info.hits,
+        'misses': info.misses,
+        'size': info.currsize,
+        'maxsize': info.maxsize,
+    }
+
 
 def format_net_timespan(time: int) -> str:
     """
@@ -13,10 +78,98 @@ def format_net_timespan(time: int) -> str:
     Returns:
     str: A .net-compliant timespan stamp.
     """
-    hours = math.floor((time / 1000 / 60 / 60))
-    minutes = math.floor((time - (hours * 60 * 60 * 1000)) / 1000 / 60)
-    seconds = math.floor((time - (hours * 60 * 60 * 1000) - (minutes * 60 * 1000)) / 1000)
-    millis = (time - (hours * 60 * 60 * 1000) - (minutes * 60 * 1000) - (seconds * 1000))
+    seconds, millis = divmod(time, 1000)
+    minutes, seconds = divmod(seconds, 60)
+    hours, minutes = divmod(minutes, 60)
+
+    return f"{hours}:{minutes}:{seconds}.{millis * 1000}"
+
+
+def format_net_timespans(times: Sequence[int]) -> List[str]:
+    """
+    Formats a whole column of millisecond times into .net-compliant timespan stamps,
+    exactly as format_net_timespan would format each of them.
+
+    Parameters:
+    times (Sequence[int]): Durations in milliseconds.
+
+    Returns:
+    List[str]: A .net-compliant timespan stamp per duration.
+    """
+    if numpy is None or len(times) < NUMPY_FORMAT_THRESHOLD:
+        return [format_net_timespan(time) for time in times]
+
+    seconds, millis = numpy.divmod(numpy.asarray(times, dtype=numpy.int64), 1000)
+    minutes, seconds = numpy.divmod(seconds, 60)
+    hours, minutes = numpy.divmod(minutes, 60)
     micros = millis * 1000
 
-    return f"{hours}:{minutes}:{seconds}.{micros}"
+    return [f"{h}:{m}:{s}.{u}" for h, m, s, u in zip(hours.tolist(), minutes.tolist(), seconds.tolist(), micros.tolist())]
+
+
+def parse_net_timespan(timespan: str) -> int:
+    """
+    Parses a timespan stamp written by format_net_timespan back into milliseconds, without going through floats.
+    The fractional part is read as a whole number of microseconds, which is how format_net_timespan writes it
+    (so "0:1:40.2000" is 100002 milliseconds).
+
+    Parameters:
+    timespan (str): A timespan stamp, e.g. "0:2:3.456000".
+
+    Returns:
+    int: The duration in milliseconds.
+    """
+    clock, _, micros = timespan.partition('.')
+    hours, minutes, seconds = clock.split(':')
+
+    return ((int(hours) * 60 + int(minutes)) * 60 + int(seconds)) * 1000 + int(micros or 0) // 1000
+
+
+def tail_lines(filepath: str, count: int, block_size: int = 8192) -> List[str]:
+    """
+    Returns the last lines of a file, reading backwards from the end so that the cost doesn't grow with the file.
+
+    Parameters:
+    filepath (str): The file to read.
+    count (int): How many lines to return, at most.
+
+    Returns:
+    list: The lines, oldest first, without their line endings.
+    """
+    if count <= 0:
+        return []
+    with open(filepath, 'rb') as input_file:
+        position = input_file.seek(0, os.SEEK_END)
+        data = b''
+        # One newline more than the lines wanted, so that the first of them is known to be whole.
+        while position > 0 and data.count(b'\n') <= count:
+            read = min(block_size, position)
+            position -= read
+            input_file.seek(position)
+            data = input_file.read(read) + data
+
+    lines = data.decode("utf-8", errors='replace').splitlines()
+    if position > 0:
+        lines = lines[1:]
+    return lines[-count:]
+
+
+@contextmanager
+def process_lock(filepath: str):
+    """
+    Holds a lock on the given file across every process (i.e. other servers sharing the matchresults directory,
+    and the archive tool),
+    using a <filepath>.lock file. This blocks: in the plugin, only take it on io_executor, while holding
+    fileio.file_lock(filepath).
+    """
+    if fcntl is None:
+        yield
+        return
+    # Commands such as //tbg standings can run before //tbg start has created the matchresults directory.
+    os.makedirs(os.path.dirname(filepath) or '.', exist_ok=True)
+    with open(f"{filepath}.lock", 'a') as lock_file:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
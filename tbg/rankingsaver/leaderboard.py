@@ -0,0 +1,137 @@
+"""
+The leaderboard module keeps the standings of the map being played up to date as players finish,
+so that nothing needs sorting when the map ends.
+"""
+from bisect import bisect_left, insort
+from typing import List, Optional
+
+from .ranking import INVALID_RACE_TIMES, competition_ranks
+
+
+class LiveLeaderboard:
+    """
+    Best race time per player for the current map, kept sorted as finishes come in.
+
+    Each entry is a (race_time, sequence, login) tuple, so players who set the same time are
+    ordered by who set it first. Finding an entry is a binary search.
+    """
+
+    def __init__(self):
+        self._entries = []
+        self._best = {}
+        self._nicknames = {}
+        self._sequence = 0
+        # Bumped on every change, so that snapshot writers can tell whether there is anything new.
+        self.version = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def reset(self):
+        """
+        Forgets all times, ready for a new map.
+        """
+        self._entries.clear()
+        self._best.clear()
+        self._nicknames.clear()
+        self.version += 1
+
+    def record(self, login: str, nickname: str, race_time: int) -> bool:
+        """
+        Records a finish. Only improvements on the player's best time change the standings.
+
+        Parameters:
+        login (str): The player's login.
+        nickname (str): The player's (styled) nickname.
+        race_time (int): The finish time in milliseconds.
+
+        Returns:
+        bool: Whether this was a new best time for the player.
+        """
+        if race_time in INVALID_RACE_TIMES:
+            return False
+
+        self._nicknames[login] = nickname
+        previous = self._best.get(login)
+        if previous is not None:
+            if race_time >= previous[0]:
+                return False
+            del self._entries[bisect_left(self._entries, previous)]
+
+        self._sequence += 1
+        entry = (race_time, self._sequence, login)
+        insort(self._entries, entry)
+        self._best[login] = entry
+        self.version += 1
+        return True
+
+    def rank(self, login: str) -> Optional[int]:
+        """
+        Returns a player's current rank, or None if they have not set a time.
+        """
+        entry = self._best.get(login)
+        if entry is None:
+            return None
+        # Everyone on the same time shares the rank of the first of them.
+        return bisect_left(self._entries, (entry[0],)) + 1
+
+    def standings(self) -> List[dict]:
+        """
+        Returns the current standings in finishing order.
+
+        Returns:
+        List[dict]: login, nickname, best_race_time and rank of every player with a time.
+        """
+        ranks = competition_ranks([entry[0] for entry in self._entries])
+        return [
+            {
+                'login': login,
+                'nickname': self._nicknames[login],
+                'best_race_time': race_time,
+                'rank': rank,
+            }
+            for (race_time, _, login), rank in zip(self._entries, ranks)
+        ]
+
+    def finishing_order(self, players: list) -> Optional[List[int]]:
+        """
+        Orders the EndMap players list using the live standings, instead of sorting it.
+
+        The result is the same order rank_race_times would give: tied players keep their order in
+        players, and players without a time follow everyone else. If the standings do not agree with
+        the players list (e.g. a finish was missed), None is returned and the caller should rank from scratch.
+
+        Parameters:
+        players (list): The players list from the scores callback.
+
+        Returns:
+        Optional[List[int]]: Indices into players in finishing order, or None.
+        """
+        index_by_login = {}
+        without_time = []
+        for index, player in enumerate(players):
+            if player['best_race_time'] in INVALID_RACE_TIMES:
+                without_time.append(index)
+            elif player.get('player') is not None:
+                index_by_login[player['player'].login] = index
+
+        if len(index_by_login) != len(self._entries):
+            return None
+
+        order = []
+        for race_time, _, login in self._entries:
+            index = index_by_login.get(login)
+            if index is None or players[index]['best_race_time'] != race_time:
+                return None
+            order.append(index)
+
+        # Ties are broken by position in players, not by who drove the time first.
+        tie_start = 0
+        for position in range(1, len(order) + 1):
+            if position == len(order) or self._entries[position][0] != self._entries[tie_start][0]:
+                if position - tie_start > 1:
+                    order[tie_start:position] = sorted(order[tie_start:position])
+                tie_start = position
+
+        without_time.sort(key=lambda i: players[i]['best_race_time'])
+        return order + without_time
@@ -0,0 +1,132 @@
+"""
+The metrics module times each phase of the EndMap pipeline, so that a slow map can be pinned on rendering,
+stripping, encoding, lock waits or the disk.
+
+    with span('render.rank'):
+        ...
+
+Timings are kept per phase as a Prometheus-style histogram plus a window of recent samples for percentiles.
+"""
+import threading
+import time
+from bisect import bisect_left
+from collections import deque
+from contextlib import contextmanager
+from typing import Dict, List
+
+# Histogram bucket upper bounds, in seconds.
+BUCKET_BOUNDS = [0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+# How many recent samples per phase percentiles are calculated from.
+PERCENTILE_WINDOW = 1024
+
+
+class Histogram:
+    """
+    Timings of a single phase. Observations may come from any thread.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.buckets = [0] * (len(BUCKET_BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.recent = deque(maxlen=PERCENTILE_WINDOW)
+
+    def observe(self, seconds: float):
+        with self._lock:
+            self.buckets[bisect_left(BUCKET_BOUNDS, seconds)] += 1
+            self.count += 1
+            self.total += seconds
+            self.recent.append(seconds)
+
+    def percentiles(self, quantiles=(0.5, 0.95, 0.99)) -> Dict[float, float]:
+        """
+        Returns the given quantiles (in seconds) of the recent samples.
+        """
+        with self._lock:
+            samples = sorted(self.recent)
+        if not samples:
+            return {q: 0.0 for q in quantiles}
+        return {q: samples[min(len(samples) - 1, int(q * len(samples)))] for q in quantiles}
+
+
+_histograms = {}
+_histograms_lock = threading.Lock()
+
+
+def histogram(phase: str) -> Histogram:
+    result = _histograms.get(phase)
+    if result is None:
+        with _histograms_lock:
+            result = _histograms.setdefault(phase, Histogram())
+    return result
+
+
+def observe(phase: str, seconds: float):
+    """
+    Records a timing for a phase.
+    """
+    histogram(phase).observe(seconds)
+
+
+@contextmanager
+def span(phase: str):
+    """
+    Times the enclosed block as the given phase.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(phase, time.perf_counter() - start)
+
+
+def phases() -> List[str]:
+    return sorted(_histograms)
+
+
+def summary(phase: str) -> dict:
+    """
+    Returns count, p50, p95 and p99 (in milliseconds) of a phase.
+    """
+    result = histogram(phase)
+    percentiles = result.percentiles()
+    return {
+        'count': result.count,
+        'p50_ms': percentiles[0.5] * 1000,
+        'p95_ms': percentiles[0.95] * 1000,
+        'p99_ms': percentiles[0.99] * 1000,
+    }
+
+
+def prometheus_text() -> str:
+    """
+    Renders every phase in the Prometheus text exposition format.
+    """
+    lines = [
+        '# HELP rankingsaver_phase_seconds Time spent in each phase of the EndMap pipeline.',
+        '# TYPE rankingsaver_phase_seconds histogram',
+    ]
+    quantile_lines = [
+        '# HELP rankingsaver_phase_quantile_seconds Recent percentiles of each phase of the EndMap pipeline.',
+        '# TYPE rankingsaver_phase_quantile_seconds gauge',
+    ]
+    for phase in phases():
+        result = histogram(phase)
+        with result._lock:
+            buckets = list(result.buckets)
+            count, total = result.count, result.total
+
+        cumulative = 0
+        for bound, bucket in zip(BUCKET_BOUNDS + ['+Inf'], buckets):
+            cumulative += bucket
+            lines.append(f'rankingsaver_phase_seconds_bucket{{phase="{phase}",le="{bound}"}} {cumulative}')
+        lines.append(f'rankingsaver_phase_seconds_sum{{phase="{phase}"}} {total}')
+        lines.append(f'rankingsaver_phase_seconds_count{{phase="{phase}"}} {count}')
+
+        for quantile, seconds in result.percentiles().items():
+            quantile_lines.append(
+                f'rankingsaver_phase_quantile_seconds{{phase="{phase}",quantile="{quantile}"}} {seconds}')
+
+    return '\n'.join(lines + quantile_lines) + '\n'
@@ -0,0 +1,153 @@
+"""
+The model module holds the documents written for each map: a RoundResult, with a RacerResult per racer and, in
+team modes, a TeamResult per team.
+
+They are __slots__ classes rather than dicts, to keep rendering big lobbies cheap, but they read like the dicts
+they replace (result['Nick'], result.get('BestTime')), so code that also reads RoundResults back from disk
+works with either. See the encoder module for serializing them.
+"""
+from collections.abc import Mapping
+from typing import List, Optional
+
+
+class RacerResult(Mapping):
+    """
+    One racer's result on a map. BestTime is left out when the racer set no valid time.
+    """
+    __slots__ = ('nick', 'rank', 'best_time')
+
+    def __init__(self, nick: Optional[str], rank: int, best_time: Optional[str] = None):
+        self.nick = nick
+        self.rank = rank
+        self.best_time = best_time
+
+    def __getitem__(self, key: str):
+        if key == 'Nick':
+            return self.nick
+        if key == 'Rank':
+            return self.rank
+        if key == 'BestTime' and self.best_time is not None:
+            return self.best_time
+        raise KeyError(key)
+
+    def __iter__(self):
+        yield 'Nick'
+        yield 'Rank'
+        if self.best_time is not None:
+            yield 'BestTime'
+
+    def __len__(self) -> int:
+        return 2 if self.best_time is None else 3
+
+    def __repr__(self) -> str:
+        return f"RacerResult({self.nick!r}, {self.rank!r}, {self.best_time!r})"
+
+    def to_dict(self) -> dict:
+        if self.best_time is None:
+            return {'Nick': self.nick, 'Rank': self.rank}
+        return {'Nick': self.nick, 'Rank': self.rank, 'BestTime': self.best_time}
+
+
+class TeamResult(Mapping):
+    """
+    One team's result on a map: the points its members scored, its fastest member's time and the average of its
+    members' top times. BestTime and TopAverage are left out when the team didn't set enough valid times.
+    """
+    __slots__ = ('name', 'rank', 'points', 'best_time', 'top_average')
+
+    def __init__(self, name: Optional[str], rank: int, points: int, best_time: Optional[str] = None,
+                 top_average: Optional[str] = None):
+        self.name = name
+        self.rank = rank
+        self.points = points
+        self.best_time = best_time
+        self.top_average = top_average
+
+    def __getitem__(self, key: str):
+        if key == 'Team':
+            return self.name
+        if key == 'Rank':
+            return self.rank
+        if key == 'Points':
+            return self.points
+        if key == 'BestTime' and self.best_time is not None:
+            return self.best_time
+        if key == 'TopAverage' and self.top_average is not None:
+            return self.top_average
+        raise KeyError(key)
+
+    def __iter__(self):
+        yield 'Team'
+        yield 'Rank'
+        yield 'Points'
+        if self.best_time is not None:
+            yield 'BestTime'
+        if self.top_average is not None:
+            yield 'TopAverage'
+
+    def __len__(self) -> int:
+        return 3 + (self.best_time is not None) + (self.top_average is not None)
+
+    def __repr__(self) -> str:
+        return (f"TeamResult({self.name!r}, {self.rank!r}, {self.points!r}, {self.best_time!r}, "
+                f"{self.top_average!r})")
+
+    def to_dict(self) -> dict:
+        result = {'Team': self.name, 'Rank': self.rank, 'Points': self.points}
+        if self.best_time is not None:
+            result['BestTime'] = self.best_time
+        if self.top_average is not None:
+            result['TopAverage'] = self.top_average
+        return result
+
+
+class RoundResult(Mapping):
+    """
+    The result of a single map, as stored in the day file's RoundResults list.
+    TeamResults is only written for maps played in teams, so individual events' day files are unchanged.
+    """
+    __slots__ = ('track_name', 'raced_at_utc', 'racer_results', 'team_results')
+
+    def __init__(self, track_name: str, raced_at_utc: str, racer_results: List[RacerResult],
+                 team_results: Optional[List[TeamResult]] = None):
+        self.track_name = track_name
+        self.raced_at_utc = raced_at_utc
+        self.racer_results = racer_results
+        self.team_results = team_results or None
+
+    def __getitem__(self, key: str):
+        if key == 'TrackName':
+            return self.track_name
+        if key == 'RacedAtUtc':
+            return self.raced_at_utc
+        if key == 'RacerResults':
+            return self.racer_results
+        if key == 'TeamResults' and self.team_results is not None:
+            return self.team_results
+        raise KeyError(key)
+
+    def __iter__(self):
+        yield 'TrackName'
+        yield 'RacedAtUtc'
+        yield 'RacerResults'
+        if self.team_results is not None:
+            yield 'TeamResults'
+
+    def __len__(self) -> int:
+        return 3 if self.team_results is None else 4
+
+    def __repr__(self) -> str:
+        if self.team_results is None:
+            return f"RoundResult({self.track_name!r}, {self.raced_at_utc!r}, {self.racer_results!r})"
+        return (f"RoundResult({self.track_name!r}, {self.raced_at_utc!r}, {self.racer_results!r}, "
+                f"{self.team_results!r})")
+
+    def to_dict(self) -> dict:
+        result = {
+            'TrackName': self.track_name,
+            'RacedAtUtc': self.raced_at_utc,
+            'RacerResults': [racer.to_dict() for racer in self.racer_results],
+        }
+        if self.team_results is not None:
+            result['TeamResults'] = [team.to_dict() for team in self.team_results]
+        return result
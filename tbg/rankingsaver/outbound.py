@@ -0,0 +1,105 @@
+"""
+The outbound module batches the plugin's chat messages and GBX calls to the dedicated server.
+
+Calls queued within OUTBOUND_WINDOW of the first are sent together as a single system.multicall instead of one
+round-trip each, so at the end of a map the winner announcement and the save confirmation share one request.
+Queuing never waits on the server; callers that need the result can await the returned future.
+"""
+import asyncio
+import logging
+from xmlrpc.client import Fault
+
+logger = logging.getLogger(__name__)
+
+# How long (in seconds) queued calls wait for company before being sent.
+OUTBOUND_WINDOW = 0.05
+
+# A batch is sent straight away once it holds this many calls.
+OUTBOUND_MAX_BATCH = 50
+
+
+class OutboundBatcher:
+    """
+    Queues GBX queries (chat messages included) and sends each window's worth in order, as one multicall.
+    """
+
+    def __init__(self, instance, window: float = OUTBOUND_WINDOW, max_batch: int = OUTBOUND_MAX_BATCH):
+        self.instance = instance
+        self.window = window
+        self.max_batch = max_batch
+        self.batches_sent = 0
+        self.calls_sent = 0
+        self._pending = []
+        self._flush_task = None
+
+    def chat(self, message: str, *players) -> asyncio.Future:
+        """
+        Queues a chat message, to everyone or to the given players.
+        """
+        # Like ChatQuery.execute, a message to a player who has just left is not an error.
+        return self._queue(self.instance.chat(message, *players).gbx_query, ignore_unknown_login=True)
+
+    def gbx(self, method: str, *args) -> asyncio.Future:
+        """
+        Queues a GBX call.
+        """
+        return self._queue(self.instance.gbx(method, *args))
+
+    def _queue(self, query, ignore_unknown_login: bool = False) -> asyncio.Future:
+        future = asyncio.get_event_loop().create_future()
+        # Nobody has to await the result, so don't let an unawaited failure be reported a second time.
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self._pending.append((query, future, ignore_unknown_login))
+
+        if len(self._pending) >= self.max_batch:
+            asyncio.ensure_future(self.flush())
+        elif self._flush_task is None:
+            self._flush_task = asyncio.ensure_future(self._flush_later())
+        return future
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.window)
+        self._flush_task = None
+        await self.flush()
+
+    async def flush(self):
+        """
+        Sends everything queued so far.
+        """
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+
+        self.batches_sent += 1
+        self.calls_sent += len(batch)
+        try:
+            if len(batch) == 1:
+                try:
+                    results = [await batch[0][0].execute()]
+                except Fault as e:
+                    results = [e]
+            else:
+                results = list(await self.instance.gbx.multicall(*[query for query, _, _ in batch]))
+        except Exception as e:
+            logger.error("Could not send %d call(s) to the dedicated server", len(batch), exc_info=e)
+            results = [Fault(-1, str(e))] * len(batch)
+
+        for index, (query, future, ignore_unknown_login) in enumerate(batch):
+            result = results[index] if index < len(results) else Fault(-1, 'No result from the dedicated server')
+            if isinstance(result, dict) and 'faultCode' in result:
+                result = Fault(result['faultCode'], result.get('faultString', ''))
+
+            if isinstance(result, Fault) and not (ignore_unknown_login and 'Login unknown' in result.faultString):
+                logger.warning("%s failed: %s", query.method, result.faultString)
+                future.set_exception(result)
+            else:
+                future.set_result(True if isinstance(result, Fault) else result)
+
+    async def close(self):
+        """
+        Sends anything still queued.
+        """
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        await self.flush()
@@ -0,0 +1,127 @@
+"""
+The push module streams new results to local clients (e.g. Scorematron), so that they don't have to poll
+and re-read the matchresults directory.
+
+The protocol is newline-delimited JSON. Each event looks like:
+
+    {"Run": "3f2a...", "Seq": 42, "Type": "RoundResult", "Data": {...}}
+
+Sequence numbers start again from 1 whenever the controller restarts, so each run of the server has its own Run id.
+After connecting, a client sends one line with the Run and Seq of the last event it saw:
+
+    {"Run": "3f2a...", "Since": 41}
+
+and receives every buffered event with a sequence number above 41, followed by new events as they happen.
+Send {"Since": null} to receive only new events.
+
+If the requested events are no longer buffered, the Run is from a previous run, or Since is not a valid sequence
+number, the client is sent {"Run": <run>, "Seq": <latest>, "Type": "Resync"} and should re-read the day file before
+carrying on from that sequence number.
+"""
+import asyncio
+import json
+import logging
+import uuid
+from collections import deque
+from typing import Optional
+
+from .encoder import dumps
+
+logger = logging.getLogger(__name__)
+
+# How many past events are kept for clients that reconnect.
+PUSH_BUFFER_SIZE = 1024
+
+# How many events may be waiting for a single client before it is considered stuck and disconnected.
+PUSH_CLIENT_QUEUE_SIZE = 256
+
+# How long (in seconds) a client has to say where it wants to resume from.
+PUSH_HELLO_TIMEOUT = 5
+
+
+class PushServer:
+    """
+    Streams sequence-numbered events to connected clients over TCP or a Unix socket.
+    """
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, path: Optional[str] = None):
+        self.host = host
+        self.port = port
+        self.path = path
+        self.run = uuid.uuid4().hex
+        self.sequence = 0
+        self._buffer = deque(maxlen=PUSH_BUFFER_SIZE)
+        self._clients = set()
+        self._server = None
+
+    async def start(self):
+        if self.path is not None:
+            self._server = await asyncio.start_unix_server(self._handle_client, path=self.path)
+        else:
+            self._server = await asyncio.start_server(self._handle_client, host=self.host, port=self.port)
+            # Pick up the real port if we asked for any free one.
+            self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        for queue in list(self._clients):
+            self._disconnect(queue)
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    def _disconnect(self, queue: asyncio.Queue):
+        self._clients.discard(queue)
+        if queue.full():
+            queue.get_nowait()
+        queue.put_nowait(None)
+
+    def publish(self, event_type: str, data: dict) -> int:
+        """
+        Sends an event to every connected client and buffers it for clients that reconnect.
+
+        Returns:
+        int: The event's sequence number.
+        """
+        self.sequence += 1
+        line = (dumps({"Run": self.run, "Seq": self.sequence, "Type": event_type, "Data": data}) + '\n').encode("utf-8")
+        self._buffer.append((self.sequence, line))
+
+        for queue in list(self._clients):
+            try:
+                queue.put_nowait(line)
+            except asyncio.QueueFull:
+                logger.warning("Disconnecting a push client that stopped reading")
+                self._disconnect(queue)
+        return self.sequence
+
+    def _backlog(self, run: Optional[str], since) -> list:
+        if since is None:
+            return []
+        valid = isinstance(since, int) and not isinstance(since, bool) and 0 <= since <= self.sequence
+        if run != self.run or not valid or (since < self.sequence and self._buffer[0][0] > since + 1):
+            # The client was connected to a previous run, asked for nonsense, or some of what it missed has
+            # already been dropped.
+            return [(dumps({"Run": self.run, "Seq": self.sequence, "Type": "Resync"}) + '\n').encode("utf-8")]
+        return [line for sequence, line in self._buffer if sequence > since]
+
+    async def _handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        queue = asyncio.Queue(maxsize=PUSH_CLIENT_QUEUE_SIZE)
+        try:
+            hello = json.loads(await asyncio.wait_for(reader.readline(), PUSH_HELLO_TIMEOUT) or b'{}')
+            # Registering and reading the backlog happen without awaiting in between, so no event can be missed.
+            self._clients.add(queue)
+            for line in self._backlog(hello.get('Run'), hello.get('Since')):
+                writer.write(line)
+
+            while True:
+                await writer.drain()
+                line = await queue.get()
+                if line is None:
+                    break
+                writer.write(line)
+        except (asyncio.TimeoutError, ValueError, AttributeError, ConnectionError):
+            pass
+        finally:
+            self._clients.discard(queue)
+            writer.close()
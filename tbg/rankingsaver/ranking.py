@@ -0,0 +1,82 @@
+"""
+The ranking module turns a lobby's best race times into a finishing order with competition ranks (1, 2, 2, 4).
+"""
+from typing import List, Sequence, Tuple
+
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None
+
+# Race times that mean "no time was set".
+INVALID_RACE_TIMES = (-1, 0)
+
+# Lobbies at least this large are ranked with NumPy, when it is available.
+NUMPY_RANKING_THRESHOLD = 2000
+
+
+def rank_race_times(times: Sequence[int]) -> Tuple[List[int], List[int]]:
+    """
+    Ranks a list of best race times.
+
+    Racers with a valid time are ordered fastest first and share a rank when tied (1, 2, 2, 4).
+    Racers without a time follow them, each with their own rank.
+    Racers with equal times keep the order they were given in.
+
+    Parameters:
+    times (Sequence[int]): Best race times in milliseconds, one per racer.
+
+    Returns:
+    Tuple[List[int], List[int]]: The racer indices in finishing order, and the rank at each finishing position.
+    """
+    if numpy is not None and len(times) >= NUMPY_RANKING_THRESHOLD:
+        return _rank_race_times_numpy(times)
+    return _rank_race_times_python(times)
+
+
+def competition_ranks(ordered_times: Sequence[int]) -> List[int]:
+    """
+    Assigns ranks to times that are already in finishing order.
+    Tied valid times share a rank (1, 2, 2, 4); racers without a time always get their own.
+
+    Parameters:
+    ordered_times (Sequence[int]): Best race times in milliseconds, in finishing order.
+
+    Returns:
+    List[int]: The rank at each finishing position.
+    """
+    ranks = []
+    previous_time = None
+    for position, time in enumerate(ordered_times):
+        if position > 0 and time == previous_time and time not in INVALID_RACE_TIMES:
+            # It's a tie, so share the previous racer's rank.
+            ranks.append(ranks[-1])
+        else:
+            ranks.append(position + 1)
+        previous_time = time
+
+    return ranks
+
+
+def _rank_race_times_python(times: Sequence[int]) -> Tuple[List[int], List[int]]:
+    order = sorted(range(len(times)), key=lambda i: (times[i] in INVALID_RACE_TIMES, times[i]))
+    return order, competition_ranks([times[i] for i in order])
+
+
+def _rank_race_times_numpy(times: Sequence[int]) -> Tuple[List[int], List[int]]:
+    race_times = numpy.asarray(times, dtype=numpy.int64)
+    invalid = numpy.isin(race_times, INVALID_RACE_TIMES)
+
+    # lexsort is stable and sorts by its last key first: valid before invalid, then fastest first.
+    order = numpy.lexsort((race_times, invalid))
+    sorted_times = race_times[order]
+
+    # A new rank starts wherever the time changes, and at every racer without a time.
+    starts_rank = numpy.ones(len(order), dtype=bool)
+    starts_rank[1:] = numpy.diff(sorted_times) != 0
+    starts_rank |= invalid[order]
+
+    positions = numpy.arange(1, len(order) + 1)
+    ranks = numpy.maximum.accumulate(numpy.where(starts_rank, positions, 0))
+
+    return order.tolist(), ranks.tolist()
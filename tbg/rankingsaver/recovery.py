@@ -0,0 +1,75 @@
+"""
+The recovery module closes the gap a controller crash can leave between the raw dumps and the day journal.
+
+Every RoundResult is saved alongside a raw dump keyed by its RacedAtUtc, so any of the newest dumps without a
+matching RoundResult is a round that was lost mid-save; it is re-rendered from the dump and journaled.
+When servers share the matchresults directory, each only recovers its own rounds.
+Only the ends of the archive index and of the journals are read, so this costs the same however long the
+tournament has been running.
+"""
+import logging
+from datetime import datetime, timedelta
+from typing import List
+
+from . import fileio
+from .archive import read_member
+from .fileio import RAW_ARCHIVE_PATH, locked, raw_archive, recent_race_times, run_io, update_matchresult
+from .rendering import build_round_result
+from .rerender import UNKNOWN_TRACK_NAME, day_of, players_from_raw
+
+logger = logging.getLogger(__name__)
+
+# How many of the newest raw dumps are checked for a matching RoundResult.
+RECOVERY_WINDOW = 16
+
+
+def _next_day(day: str) -> str:
+    return (datetime.strptime(day, '%Y-%m-%d') + timedelta(days=1)).strftime('%Y-%m-%d')
+
+
+async def recover_matchresults(window: int = RECOVERY_WINDOW) -> List[str]:
+    """
+    recover_matchresults re-renders any of the newest raw dumps that has no matching RoundResult in the journal.
+
+    Parameters:
+    window (int): How many of the newest raw dumps to check.
+
+    Returns:
+    list: The keys of the dumps that were recovered.
+    """
+    async with locked(RAW_ARCHIVE_PATH):
+        recent = await run_io(raw_archive.tail, window)
+    if not recent:
+        return []
+
+    # Rounds are journaled under the server's local date when they were saved, which is the next day
+    # for a map that ended just before midnight.
+    days = set()
+    for key, _ in recent:
+        days.add(day_of(key))
+        days.add(_next_day(day_of(key)))
+    raced_at = set()
+    for day in sorted(days):
+        raced_at |= await recent_race_times(day, window)
+
+    recovered = []
+    for key, location in recent:
+        if key in raced_at:
+            continue
+        try:
+            data = await run_io(read_member, *location)
+            if 'MapName' not in data:
+                # Dumps taken before they shared a timestamp with their RoundResult can't be matched up.
+                continue
+            if data.get('Server') != fileio.server_id:
+                # Another server's round, which it may still be saving.
+                continue
+            round_result = build_round_result(data['MapName'] or UNKNOWN_TRACK_NAME, players_from_raw(data),
+                                              data.get('Teams', []), raced_at=key)
+            await update_matchresult(round_result, day_of(key))
+        except Exception as e:
+            logger.error("Could not recover the round from raw dump %s", key, exc_info=e)
+            continue
+        logger.warning("Recovered the round from raw dump %s, which was never journaled", key)
+        recovered.append(key)
+    return recovered
@@ -0,0 +1,159 @@
+"""
+The rendering module turns map end scores into Scorematron RoundResult documents.
+It does not depend on PyPlanet, so that results can be re-rendered offline.
+"""
+from datetime import datetime
+from typing import List, Optional
+
+from . import metrics
+from .helpers import format_net_timespan, format_net_timespans, strip_styles
+from .leaderboard import LiveLeaderboard
+from .model import RacerResult, RoundResult, TeamResult
+from .ranking import INVALID_RACE_TIMES, competition_ranks, rank_race_times
+from .standings import TEAM_TOP_N, points_for_rank
+
+
+async def get_round_result_winner(round_result: dict) -> Optional[str]:
+    """
+    get_round_result_winner returns the player with the fastest valid time.
+    If there are no valid times, this returns None.
+
+    Returns:
+        str: The nickname of the winning player, or None if there are no valid times.
+    """
+    if round_result.get('RacerResults', None) is not None and len(round_result['RacerResults']) > 0:
+        if round_result['RacerResults'][0].get('BestTime', None) is not None:
+            return round_result.get('RacerResults')[0].get('Nick', "Unknown Racer")
+
+    # There are no valid times.
+    return None
+
+
+async def render_map_result(map_name: str, players: dict, teams: dict,
+                            leaderboard: Optional[LiveLeaderboard] = None, raced_at: Optional[str] = None) -> RoundResult:
+    """
+    render_map_result returns a correctly formatted dictionary ready to be saved to disk.
+    This function only works properly in time attack.
+    In team modes, pass the scores callback's teams to also get a TeamResult per team; otherwise pass no teams.
+    If the live leaderboard for the map is given and agrees with players, its order is used instead of sorting.
+
+    Returns:
+        RoundResult: The RoundResult object.
+    """
+    return build_round_result(map_name, players, teams, leaderboard, raced_at)
+
+
+def build_round_result(map_name: str, players: dict, teams: dict,
+                       leaderboard: Optional[LiveLeaderboard] = None, raced_at: Optional[str] = None) -> RoundResult:
+    """
+    build_round_result is render_map_result for callers outside of an event loop, such as the offline re-render tool.
+    raced_at defaults to now.
+
+    Returns:
+        RoundResult: The RoundResult object.
+    """
+    timestr = raced_at if raced_at is not None else datetime.utcnow().isoformat()
+
+    # Rank everyone with a single sort; racers without a time are put to the back of the queue.
+    with metrics.span('render.rank'):
+        players = list(players)
+        order = leaderboard.finishing_order(players) if leaderboard is not None else None
+        if order is None:
+            order, ranks = rank_race_times([player['best_race_time'] for player in players])
+        else:
+            ranks = competition_ranks([players[index]['best_race_time'] for index in order])
+
+    # best_race_time is stored in milliseconds.
+    with metrics.span('render.format'):
+        race_times = [int(players[index].get('best_race_time')) for index in order]
+        best_times = format_net_timespans(race_times)
+
+    with metrics.span('render.strip'):
+        nicks = [strip_styles(players[index]['player'].nickname) for index in order]
+
+    # Team names by id, from the scores callback. Without teams, there's nothing to aggregate.
+    team_names = {team['id']: team.get('name') for team in teams or [] if team.get('id') is not None}
+
+    # Only write a time to the output if a valid time was set by the racer.
+    # Teams are tallied in the same pass; racers come fastest first, so each team's times do too.
+    racer_results = []
+    team_members = {team_id: [] for team_id in team_names}
+    for index, nick, rank, race_time, best_time in zip(order, nicks, ranks, race_times, best_times):
+        valid = race_time not in INVALID_RACE_TIMES
+        racer_results.append(RacerResult(nick, rank, best_time if valid else None))
+        if team_names and valid:
+            members = team_members.get(player_team_id(players[index]))
+            if members is not None:
+                members.append((rank, race_time))
+
+    team_results = None
+    if team_names:
+        with metrics.span('render.teams'):
+            team_results = build_team_results(team_names, team_members)
+
+    return RoundResult(strip_styles(map_name), timestr, racer_results, team_results)
+
+
+def player_team_id(player: dict):
+    """
+    Returns the id of the team a scores callback player is on, or None if it isn't known.
+    """
+    return getattr(getattr(player.get('player'), 'flow', None), 'team_id', None)
+
+
+def build_team_results(team_names: dict, team_members: dict) -> List[TeamResult]:
+    """
+    Aggregates each team's finishers into a TeamResult: the points its members scored, its best time, and the
+    average of its TEAM_TOP_N best times. Teams are ranked by points, then by best time.
+
+    Parameters:
+    team_names (dict): Team names, by team id.
+    team_members (dict): Each team's finishers as (rank, race time) pairs, fastest first, by team id.
+
+    Returns:
+    list: The TeamResults, in finishing order.
+    """
+    tallies = []
+    for team_id, name in team_names.items():
+        members = team_members.get(team_id, [])
+        points = sum(points_for_rank(rank) for rank, _ in members)
+        best_time = members[0][1] if members else None
+        top_times = [race_time for _, race_time in members[:TEAM_TOP_N]]
+        top_average = round(sum(top_times) / TEAM_TOP_N) if len(top_times) == TEAM_TOP_N else None
+        tallies.append((strip_styles(name), points, best_time, top_average))
+    tallies.sort(key=lambda tally: (-tally[1], tally[2] is None, tally[2] or 0))
+
+    team_results = []
+    for position, (name, points, best_time, top_average) in enumerate(tallies):
+        rank = position + 1
+        if team_results and (points, best_time) == (tallies[position - 1][1], tallies[position - 1][2]):
+            rank = team_results[-1].rank
+        team_results.append(TeamResult(
+            name, rank, points,
+            format_net_timespan(best_time) if best_time is not None else None,
+            format_net_timespan(top_average) if top_average is not None else None,
+        ))
+    return team_results
+
+
+def render_live_standings(map_name: str, leaderboard: LiveLeaderboard) -> dict:
+    """
+    render_live_standings returns the current standings of the map being played, laid out like a RoundResult.
+
+    Returns:
+        dict: The live standings object.
+    """
+    standings = leaderboard.standings()
+    best_times = format_net_timespans([standing['best_race_time'] for standing in standings])
+    return {
+        "TrackName": strip_styles(map_name),
+        "UpdatedAtUtc": datetime.utcnow().isoformat(),
+        "RacerResults": [
+            {
+                'Nick': strip_styles(standing['nickname']),
+                'Rank': standing['rank'],
+                'BestTime': best_time,
+            }
+            for standing, best_time in zip(standings, best_times)
+        ],
+    }
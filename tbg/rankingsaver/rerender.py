@@ -0,0 +1,148 @@
+"""
+The rerender module rebuilds RoundResults from raw map end dumps, without a running PyPlanet.
+Use it to backfill day files after a crash, or to regenerate them after a change to ranking or formatting.
+
+    python -m tbg.rankingsaver.rerender --output rerendered --workers 8
+
+Dumps are read from the raw archive and from any raw_<timestamp>.json files that were never migrated,
+rendered across a pool of worker processes, and written out in order as one day file per day.
+The matchresults directory itself is never modified.
+"""
+import argparse
+import glob
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from types import SimpleNamespace
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+from .archive import RawArchive, read_member
+from .encoder import day_file_fragment
+from .rendering import build_round_result
+
+# Dumps taken before the map name was recorded are rendered under this track name.
+UNKNOWN_TRACK_NAME = "Unknown Track"
+
+# How many dumps are handed to a worker at a time.
+RERENDER_CHUNK_SIZE = 16
+
+
+def raw_dump_sources(directory: str) -> List[Tuple[str, tuple]]:
+    """
+    Lists every raw dump under a matchresults directory, oldest first.
+    Each source is either ('archive', segment_path, offset, length) or ('file', path), so that workers can read
+    dumps themselves instead of having them pickled across.
+
+    Returns:
+    list: (key, source) pairs.
+    """
+    sources = {}
+    for filepath in glob.glob(os.path.join(directory, "raw_*.json")):
+        sources[os.path.basename(filepath)[len("raw_"):-len(".json")]] = ('file', filepath)
+
+    # Prefer the archived copy of anything that was migrated but not removed.
+    archive = RawArchive(os.path.join(directory, 'raw'))
+    for key in archive.keys():
+        sources[key] = ('archive',) + archive.locate(key)
+
+    return sorted(sources.items())
+
+
+def load_raw_dump(source: tuple) -> dict:
+    if source[0] == 'archive':
+        return read_member(*source[1:])
+    with open(source[1], 'r', encoding="utf-8") as raw_file:
+        return json.load(raw_file)
+
+
+def players_from_raw(data: dict) -> list:
+    """
+    Rebuilds the scores callback's players list from a raw dump, as far as render_map_result needs it.
+    """
+    players = []
+    for player_data in data.get('Players', []):
+        race_time = player_data.get('best_race_time')
+        nickname = player_data.get('nickname') or player_data.get('login') or "Unknown Racer"
+        players.append({
+            # Raw dumps record 'UNKNOWN' for fields the server didn't send; treat those as no time.
+            'best_race_time': race_time if isinstance(race_time, int) else -1,
+            'player': SimpleNamespace(nickname=nickname, login=player_data.get('login'),
+                                      flow=SimpleNamespace(team_id=player_data.get('team_id'))),
+        })
+    return players
+
+
+def rerender_dump(task: Tuple[str, tuple]) -> Tuple[str, dict]:
+    """
+    Renders one raw dump into its RoundResult. Runs in a worker process.
+    """
+    key, source = task
+    data = load_raw_dump(source)
+    return key, build_round_result(data.get('MapName') or UNKNOWN_TRACK_NAME, players_from_raw(data),
+                                   data.get('Teams', []), raced_at=key)
+
+
+def day_of(key: str) -> str:
+    """
+    Returns the day file a dump belongs in. Keys are UTC, but the plugin names day files by the server's local date.
+    """
+    return datetime.fromisoformat(key).replace(tzinfo=timezone.utc).astimezone().strftime('%Y-%m-%d')
+
+
+def rerender(tasks: Iterable[Tuple[str, tuple]], workers: Optional[int] = None) -> Iterator[Tuple[str, dict]]:
+    """
+    Renders raw dumps across a pool of worker processes, yielding (key, RoundResult) in the order given.
+    """
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        yield from pool.map(rerender_dump, tasks, chunksize=RERENDER_CHUNK_SIZE)
+
+
+def write_day_files(results: Iterable[Tuple[str, dict]], output_directory: str) -> List[str]:
+    """
+    Streams rendered RoundResults, oldest first, into one day file per day.
+    Day files are laid out exactly like the ones the plugin exports.
+
+    Returns:
+    list: The days written.
+    """
+    os.makedirs(output_directory, exist_ok=True)
+    days = []
+    day_file = None
+    try:
+        for key, round_result in results:
+            day = day_of(key)
+            if not days or days[-1] != day:
+                if day_file is not None:
+                    day_file.write('\n    ]\n}')
+                    day_file.close()
+                day_file = open(os.path.join(output_directory, f"{day}.json"), 'w', encoding="utf-8")
+                day_file.write('{\n    "RoundResults": [\n')
+                days.append(day)
+            else:
+                day_file.write(',\n')
+            day_file.write(day_file_fragment(round_result))
+    finally:
+        if day_file is not None:
+            day_file.write('\n    ]\n}')
+            day_file.close()
+    return days
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Re-render RoundResults from raw map end dumps.')
+    parser.add_argument('--directory', default='matchresults', help='The matchresults directory to read from.')
+    parser.add_argument('--output', required=True, help='Where to write the re-rendered day files.')
+    parser.add_argument('--workers', type=int, default=None, help='Worker processes (default: one per CPU).')
+    args = parser.parse_args(argv)
+
+    if os.path.abspath(args.output) == os.path.abspath(args.directory):
+        parser.error("--output must not be the matchresults directory")
+
+    tasks = raw_dump_sources(args.directory)
+    days = write_day_files(rerender(tasks, args.workers), args.output)
+    print(f"Re-rendered {len(tasks)} dumps into {len(days)} day files.")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,220 @@
+"""
+The splits module records each racer's best-run checkpoint times in a compact columnar layout, for sector
+analysis after the event. It is opt-in (see the record_splits setting), as raw dumps don't need it.
+
+Each map is one block of little-endian int32 columns, appended to rolling segment files like the raw archive:
+
+    header          magic "TBGS", version, player count, checkpoint time count, string table length
+    login_ids       int32[players]      index into the string table
+    nickname_ids    int32[players]      index into the string table
+    best_race_times int32[players]      milliseconds, -1 for no time
+    row_offsets     int32[players + 1]  player i's checkpoints are checkpoint_times[row_offsets[i]:row_offsets[i+1]]
+    checkpoint_times int32[...]         milliseconds since the start, per checkpoint
+    string table    JSON list of the distinct logins and nicknames, padded to 4 bytes
+
+The reader memory-maps the segment and hands out memoryviews (or NumPy arrays) over the columns without copying:
+
+    python -m tbg.rankingsaver.splits list
+    python -m tbg.rankingsaver.splits show 2025-03-30T21:52:51.961133
+"""
+import argparse
+import json
+import mmap
+import os
+import struct
+import sys
+from array import array
+from typing import List, Optional
+
+from .archive import RawArchive
+
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None
+
+SPLITS_MAGIC = b'TBGS'
+SPLITS_VERSION = 1
+SPLITS_HEADER = struct.Struct('<4sIIII')
+
+
+def _int32_column(values) -> array:
+    column = array('i', values)
+    if sys.byteorder != 'little':  # pragma: no cover
+        column.byteswap()
+    return column
+
+
+def _race_time(value) -> int:
+    # Raw scores may be missing fields; store those as no time.
+    return value if isinstance(value, int) else -1
+
+
+def encode_splits(players: list) -> bytes:
+    """
+    Packs the scores callback's players into a splits block.
+
+    Parameters:
+    players (list): The players from the scores callback, with their best_race_checkpoints.
+
+    Returns:
+    bytes: The block, a multiple of 4 bytes long.
+    """
+    strings = {}
+    login_ids, nickname_ids, best_race_times, row_offsets, checkpoint_times = [], [], [], [0], []
+    for player in players:
+        login = player['player'].login if player.get('player') is not None else ''
+        nickname = player['player'].nickname if player.get('player') is not None else ''
+        login_ids.append(strings.setdefault(login, len(strings)))
+        nickname_ids.append(strings.setdefault(nickname, len(strings)))
+        best_race_times.append(_race_time(player.get('best_race_time')))
+        checkpoint_times.extend(_race_time(t) for t in player.get('best_race_checkpoints') or [])
+        row_offsets.append(len(checkpoint_times))
+
+    string_table = json.dumps(list(strings)).encode("utf-8")
+    return b''.join([
+        SPLITS_HEADER.pack(SPLITS_MAGIC, SPLITS_VERSION, len(players), len(checkpoint_times), len(string_table)),
+        _int32_column(login_ids).tobytes(),
+        _int32_column(nickname_ids).tobytes(),
+        _int32_column(best_race_times).tobytes(),
+        _int32_column(row_offsets).tobytes(),
+        _int32_column(checkpoint_times).tobytes(),
+        string_table,
+        b'\0' * (-len(string_table) % 4),
+    ])
+
+
+class MapSplits:
+    """
+    One map's splits, read straight out of a buffer (usually a memory-mapped segment) without copying the columns.
+    Close it (or use it as a context manager) before closing the buffer.
+    """
+
+    def __init__(self, buffer, offset: int = 0, length: Optional[int] = None):
+        self._buffer = buffer
+        view = memoryview(buffer)
+        self._view = view[offset:offset + length] if length is not None else view[offset:]
+        magic, version, players, checkpoint_count, string_table_length = SPLITS_HEADER.unpack_from(self._view)
+        if magic != SPLITS_MAGIC or version != SPLITS_VERSION:
+            raise ValueError("Not a splits block")
+        if sys.byteorder != 'little':  # pragma: no cover
+            raise ValueError("Splits blocks can only be memory-mapped on little-endian machines")
+
+        self._columns = []
+        position = SPLITS_HEADER.size
+        for name, count in [('login_ids', players), ('nickname_ids', players), ('best_race_times', players),
+                            ('row_offsets', players + 1), ('checkpoint_times', checkpoint_count)]:
+            column = self._view[position:position + 4 * count].cast('i')
+            setattr(self, name, column)
+            self._columns.append(column)
+            position += 4 * count
+        self.strings = json.loads(bytes(self._view[position:position + string_table_length]))
+
+    def __len__(self) -> int:
+        return len(self.login_ids)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        for column in self._columns:
+            column.release()
+        self._view.release()
+        if isinstance(self._buffer, mmap.mmap):
+            self._buffer.close()
+
+    def login(self, index: int) -> str:
+        return self.strings[self.login_ids[index]]
+
+    def nickname(self, index: int) -> str:
+        return self.strings[self.nickname_ids[index]]
+
+    def checkpoints(self, index: int) -> memoryview:
+        """
+        Returns a player's checkpoint times (milliseconds since the start), without copying them.
+        """
+        return self.checkpoint_times[self.row_offsets[index]:self.row_offsets[index + 1]]
+
+    def sectors(self, index: int) -> List[int]:
+        """
+        Returns how long a player took over each sector, i.e. between consecutive checkpoints.
+        """
+        checkpoints = self.checkpoints(index)
+        return [checkpoint - previous for previous, checkpoint in zip([0] + list(checkpoints), checkpoints)]
+
+    def to_numpy(self) -> dict:
+        """
+        Returns every column as a NumPy int32 array over the same memory.
+        """
+        if numpy is None:
+            raise RuntimeError("NumPy is not installed")
+        return {
+            name: numpy.frombuffer(column, dtype='<i4')
+            for name, column in zip(['login_ids', 'nickname_ids', 'best_race_times', 'row_offsets',
+                                     'checkpoint_times'], self._columns)
+        }
+
+
+def load_splits(segment_path: str, offset: int, length: int) -> MapSplits:
+    """
+    Memory-maps a segment and returns the splits block at the given offset.
+    """
+    with open(segment_path, 'rb') as segment_file:
+        mapped = mmap.mmap(segment_file.fileno(), 0, access=mmap.ACCESS_READ)
+    return MapSplits(mapped, offset, length)
+
+
+class SplitsArchive(RawArchive):
+    """
+    Splits blocks, keyed like the raw dumps they were taken with, in segment-NNNNN.splits files.
+    """
+
+    segment_extension = 'splits'
+
+    def _encode_member(self, data: bytes) -> bytes:
+        # Blocks are encoded by the caller; keeping them 4-byte aligned lets the reader cast them in place.
+        return data + b'\0' * (-len(data) % 4)
+
+    def read(self, key: str) -> Optional[MapSplits]:
+        """
+        Returns a map's splits, memory-mapped.
+        """
+        location = self.locate(key)
+        if location is None:
+            return None
+        return load_splits(*location)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Browse recorded checkpoint splits.')
+    parser.add_argument('--directory', default='matchresults', help='The matchresults directory.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('list', help='List maps with recorded splits.')
+    show_parser = subparsers.add_parser('show', help="Print one map's splits and sector times.")
+    show_parser.add_argument('key')
+    args = parser.parse_args(argv)
+
+    archive = SplitsArchive(os.path.join(args.directory, 'splits'))
+    if args.command == 'list':
+        for key in archive.keys():
+            print(key)
+    elif args.command == 'show':
+        splits = archive.read(args.key)
+        if splits is None:
+            sys.exit(f"No splits recorded for {args.key}")
+        with splits:
+            for index in range(len(splits)):
+                print(json.dumps({
+                    'Login': splits.login(index),
+                    'Nickname': splits.nickname(index),
+                    'BestRaceTime': splits.best_race_times[index],
+                    'Checkpoints': list(splits.checkpoints(index)),
+                    'Sectors': splits.sectors(index),
+                }))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+"""
+The standings module keeps the overall tournament table: cumulative points, maps played and best times per player,
+and per team for maps played in teams, updated one RoundResult at a time so that history never needs to be re-read.
+"""
+from typing import List
+
+from .helpers import format_net_timespan, parse_net_timespan
+
+# Points awarded for each finishing rank on a map (rank 1 first). Racers without a time score nothing.
+POINTS_TABLE = [25, 18, 15, 12, 10, 8, 6, 4, 2, 1]
+
+# A team's TopAverage is the average of its members' best times on a map, over this many of its fastest members.
+TEAM_TOP_N = 3
+
+
+def points_for_rank(rank: int) -> int:
+    """
+    Returns the points a racer earns for finishing a map at the given rank.
+    """
+    if 1 <= rank <= len(POINTS_TABLE):
+        return POINTS_TABLE[rank - 1]
+    return 0
+
+
+class StandingsIndex:
+    """
+    Per-player and per-team running totals across every round counted so far.
+    Players are keyed by their stripped nickname, and teams by their name, as that is all a RoundResult records.
+    """
+
+    def __init__(self, data: dict = None):
+        data = data or {}
+        self.rounds_counted = data.get('RoundsCounted', 0)
+        self.players = data.get('Players', {})
+        self.teams = data.get('Teams', {})
+        # How far into each day journal (by file name) rounds have been counted.
+        self.journals = data.get('Journals', {})
+
+    def to_dict(self) -> dict:
+        return {
+            'RoundsCounted': self.rounds_counted,
+            'Players': self.players,
+            'Teams': self.teams,
+            'Journals': self.journals,
+        }
+
+    @staticmethod
+    def _add_result(totals: dict, key: str, track_name: str, result: dict):
+        entry = totals.setdefault(key, {
+            'Points': 0,
+            'MapsPlayed': 0,
+            'BestTimes': {},
+        })
+        entry['MapsPlayed'] += 1
+        if result.get('BestTime') is None:
+            return
+
+        entry['Points'] += result['Points'] if 'Points' in result else points_for_rank(result['Rank'])
+        race_time = parse_net_timespan(result['BestTime'])
+        best_time = entry['BestTimes'].get(track_name)
+        if best_time is None or race_time < best_time:
+            entry['BestTimes'][track_name] = race_time
+
+    def add_round(self, round_result: dict):
+        """
+        Adds one RoundResult to the running totals.
+        """
+        track_name = round_result.get('TrackName')
+        for racer in round_result.get('RacerResults', []):
+            self._add_result(self.players, racer['Nick'], track_name, racer)
+        for team in round_result.get('TeamResults', []):
+            self._add_result(self.teams, team['Team'], track_name, team)
+
+        self.rounds_counted += 1
+
+    @staticmethod
+    def _table(totals: dict, name_key: str) -> List[dict]:
+        # Most points first; ties go to the fastest best time on any track, then by name.
+        def order(item):
+            name, entry = item
+            best_time = min(entry['BestTimes'].values(), default=None)
+            return -entry['Points'], best_time is None, best_time or 0, str(name)
+
+        ordered = sorted(totals.items(), key=order)
+
+        table = []
+        for position, item in enumerate(ordered):
+            name, entry = item
+            rank = position + 1
+            if table and order(ordered[position - 1])[:3] == order(item)[:3]:
+                rank = table[-1]['Rank']
+            table.append({
+                name_key: name,
+                'Rank': rank,
+                'Points': entry['Points'],
+                'MapsPlayed': entry['MapsPlayed'],
+                'BestTimes': {track: format_net_timespan(t) for track, t in entry['BestTimes'].items()},
+            })
+        return table
+
+    def table(self) -> List[dict]:
+        """
+        Returns the overall table, most points first. Players on equal points are ordered by their fastest best
+        time, and only share a rank if that is equal too.
+        """
+        return self._table(self.players, 'Nick')
+
+    def team_table(self) -> List[dict]:
+        """
+        Returns the overall team table, ordered and ranked like the player table.
+        """
+        return self._table(self.teams, 'Team')
@@ -0,0 +1,160 @@
+"""
+The store module is an optional SQLite copy of everything written to the matchresults directory,
+indexed so that history ("best time on this track", "player X's results") can be looked up without reading every file.
+"""
+import sqlite3
+from typing import Iterable, List
+
+from .helpers import format_net_timespan, parse_net_timespan
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tracks (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS rounds (
+    id INTEGER PRIMARY KEY,
+    track_id INTEGER NOT NULL REFERENCES tracks(id),
+    raced_at_utc TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS rounds_track ON rounds(track_id, raced_at_utc);
+CREATE TABLE IF NOT EXISTS racers (
+    round_id INTEGER NOT NULL REFERENCES rounds(id),
+    nick TEXT NOT NULL,
+    rank INTEGER NOT NULL,
+    best_time_ms INTEGER
+);
+CREATE INDEX IF NOT EXISTS racers_round ON racers(round_id);
+CREATE INDEX IF NOT EXISTS racers_nick ON racers(nick);
+CREATE TABLE IF NOT EXISTS raw_players (
+    raw_key TEXT NOT NULL,
+    login TEXT,
+    nickname TEXT,
+    best_race_time INTEGER,
+    best_lap_time INTEGER
+);
+CREATE INDEX IF NOT EXISTS raw_players_key ON raw_players(raw_key);
+CREATE INDEX IF NOT EXISTS raw_players_login ON raw_players(login);
+"""
+
+
+class ResultStore:
+    """
+    A SQLite database of rounds, racers, tracks and raw player dumps.
+    Not thread safe; callers serialize access (see fileio.file_lock).
+    """
+
+    def __init__(self, path: str):
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        # WAL with synchronous=NORMAL is still crash safe, and the JSON files remain the source of truth.
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.executescript(SCHEMA)
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+    def _track_id(self, name: str) -> int:
+        self.connection.execute('INSERT OR IGNORE INTO tracks (name) VALUES (?)', (name,))
+        return self.connection.execute('SELECT id FROM tracks WHERE name = ?', (name,)).fetchone()[0]
+
+    @property
+    def imported(self) -> bool:
+        """
+        Whether the rounds recorded before this database was created have been imported (see import_rounds).
+        """
+        return self.connection.execute('PRAGMA user_version').fetchone()[0] >= 1
+
+    def add_round(self, round_result: dict):
+        """
+        Stores a RoundResult and all of its racers in a single transaction.
+        A round that is already stored (the same track, raced at the same time) is skipped.
+        """
+        with self.connection:
+            self._add_round(round_result)
+
+    def import_rounds(self, round_results: Iterable[dict]) -> int:
+        """
+        Stores the rounds recorded before this database was created, in a single transaction,
+        and marks it as imported.
+
+        Returns:
+        int: The number of rounds stored.
+        """
+        stored = 0
+        with self.connection:
+            for round_result in round_results:
+                stored += self._add_round(round_result)
+            self.connection.execute('PRAGMA user_version = 1')
+        return stored
+
+    def _add_round(self, round_result: dict) -> bool:
+        track_id = self._track_id(round_result['TrackName'])
+        # A round saved while the import was reading the journals is offered twice.
+        if self.connection.execute('SELECT 1 FROM rounds WHERE track_id = ? AND raced_at_utc = ?',
+                                   (track_id, round_result['RacedAtUtc'])).fetchone():
+            return False
+        cursor = self.connection.execute(
+            'INSERT INTO rounds (track_id, raced_at_utc) VALUES (?, ?)', (track_id, round_result['RacedAtUtc']))
+        self.connection.executemany(
+            'INSERT INTO racers (round_id, nick, rank, best_time_ms) VALUES (?, ?, ?, ?)',
+            [
+                (cursor.lastrowid, racer['Nick'], racer['Rank'],
+                 parse_net_timespan(racer['BestTime']) if racer.get('BestTime') is not None else None)
+                for racer in round_result.get('RacerResults', [])
+            ])
+        return True
+
+    def add_raw_dump(self, key: str, data: dict):
+        """
+        Stores a raw map end dump in a single transaction.
+        """
+        with self.connection:
+            self.connection.executemany(
+                'INSERT INTO raw_players (raw_key, login, nickname, best_race_time, best_lap_time) '
+                'VALUES (?, ?, ?, ?, ?)',
+                [
+                    (key, player.get('login'), player.get('nickname'),
+                     _int_or_none(player.get('best_race_time')), _int_or_none(player.get('best_lap_time')))
+                    for player in data.get('Players', [])
+                ])
+
+    def best_times(self, track_name: str, limit: int = 10) -> List[dict]:
+        """
+        Returns the fastest times ever set on a track, one per racer, fastest first.
+        """
+        rows = self.connection.execute(
+            'SELECT racers.nick, MIN(racers.best_time_ms), rounds.raced_at_utc FROM racers '
+            'JOIN rounds ON rounds.id = racers.round_id '
+            'JOIN tracks ON tracks.id = rounds.track_id '
+            'WHERE tracks.name = ? AND racers.best_time_ms IS NOT NULL '
+            'GROUP BY racers.nick ORDER BY MIN(racers.best_time_ms) LIMIT ?',
+            (track_name, limit)).fetchall()
+        return [
+            {'Nick': nick, 'BestTime': format_net_timespan(best_time_ms), 'RacedAtUtc': raced_at_utc}
+            for nick, best_time_ms, raced_at_utc in rows
+        ]
+
+    def player_history(self, nick: str, limit: int = 10) -> List[dict]:
+        """
+        Returns a racer's most recent results, newest first.
+        """
+        rows = self.connection.execute(
+            'SELECT tracks.name, rounds.raced_at_utc, racers.rank, racers.best_time_ms FROM racers '
+            'JOIN rounds ON rounds.id = racers.round_id '
+            'JOIN tracks ON tracks.id = rounds.track_id '
+            'WHERE racers.nick = ? ORDER BY rounds.raced_at_utc DESC LIMIT ?',
+            (nick, limit)).fetchall()
+        history = []
+        for track_name, raced_at_utc, rank, best_time_ms in rows:
+            result = {'TrackName': track_name, 'RacedAtUtc': raced_at_utc, 'Rank': rank}
+            if best_time_ms is not None:
+                result['BestTime'] = format_net_timespan(best_time_ms)
+            history.append(result)
+        return history
+
+
+def _int_or_none(value):
+    # Raw dumps record 'UNKNOWN' for fields the server didn't send.
+    return value if isinstance(value, int) else None
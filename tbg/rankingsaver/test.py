@@ -1,8 +1,50 @@
+import asyncio
+import cProfile
+import glob
+import json
+import multiprocessing
+import os
+import pstats
+import sys
+import threading
+import time
 import unittest
+from types import SimpleNamespace
+from xmlrpc.client import Fault
 
 import pyplanet.apps.core.maniaplanet.models
+import pytest
 
 from tbg.rankingsaver import get_round_result_winner, render_map_result
+from tbg.rankingsaver import encoder, fileio, helpers, metrics, ranking
+from tbg.rankingsaver import app as app_module
+from tbg.rankingsaver.app import RankingSaverApp
+from tbg.rankingsaver.archive import RawArchive, migrate_raw_files
+from tbg.rankingsaver.helpers import process_lock
+from tbg.rankingsaver.leaderboard import LiveLeaderboard
+from tbg.rankingsaver.model import RacerResult, RoundResult, TeamResult
+from tbg.rankingsaver.outbound import OutboundBatcher
+from tbg.rankingsaver.push import PushServer
+from tbg.rankingsaver.recovery import recover_matchresults
+from tbg.rankingsaver.rerender import main as rerender_main
+from tbg.rankingsaver.splits import SplitsArchive
+from tbg.rankingsaver.standings import StandingsIndex
+from tbg.rankingsaver.store import ResultStore
+
+
+@pytest.fixture(autouse=True)
+def fresh_fileio_state(monkeypatch):
+    # fileio keeps the standings, day caches and archives at module level; give every test its own.
+    monkeypatch.setattr(fileio, 'raw_archive', RawArchive(fileio.RAW_ARCHIVE_PATH))
+    monkeypatch.setattr(fileio, 'splits_archive', SplitsArchive(fileio.SPLITS_ARCHIVE_PATH))
+    monkeypatch.setattr(fileio, '_standings', None)
+    monkeypatch.setattr(fileio, '_standings_unsaved', 0)
+    monkeypatch.setattr(fileio, '_standings_pending', False)
+    monkeypatch.setattr(fileio, '_day_caches', {})
+    monkeypatch.setattr(fileio, '_pending_exports', set())
+    monkeypatch.setattr(fileio, 'server_id', None)
+    monkeypatch.setattr(fileio, '_io_profiles', None)
+    monkeypatch.setattr(fileio, 'result_store', None)
 
 
 class TestGetRoundResultWinner(unittest.TestCase):
@@ -198,4 +240,914 @@ class TestRenderMapResult:
         rcr = round_result['RacerResults'][4]
         assert rcr['Nick'] == "Racer5"
         assert rcr['Rank'] == 5
-        assert rcr.get('BestTime') is None
\ No newline at end of file
+        assert rcr.get('BestTime') is None
+
+    async def test_teams(self):
+        players = [
+            dict(player=SimpleNamespace(nickname=f"Racer{n}", flow=SimpleNamespace(team_id=team_id)),
+                 best_race_time=race_time)
+            for n, (team_id, race_time) in enumerate([(0, 100000), (1, 100100), (0, 100200), (1, 100300),
+                                                      (0, 100400), (1, -1)], 1)
+        ]
+        teams = [{'id': 0, 'name': "$00fBlue", 'map_points': 0}, {'id': 1, 'name': "$f00Red", 'map_points': 0}]
+
+        round_result = await render_map_result("Training - 01", players, teams)
+        assert [team.to_dict() for team in round_result['TeamResults']] == [
+            {"Team": "Blue", "Rank": 1, "Points": 25 + 15 + 10, "BestTime": helpers.format_net_timespan(100000),
+             "TopAverage": helpers.format_net_timespan(100200)},
+            {"Team": "Red", "Rank": 2, "Points": 18 + 12, "BestTime": helpers.format_net_timespan(100100)},
+        ]
+        # Without teams, RoundResults are laid out as they always were.
+        assert 'TeamResults' not in await render_map_result("Training - 01", players, [])
+
+
+class TestRankRaceTimes:
+    def test_competition_ranks(self):
+        order, ranks = ranking.rank_race_times([100003, 0, 100000, 100003, -1, 100002])
+        assert order == [2, 5, 0, 3, 4, 1]
+        assert ranks == [1, 2, 3, 3, 5, 6]
+
+    def test_numpy_matches_python(self):
+        pytest.importorskip('numpy')
+        times = [(i * 7919) % 500 - 1 for i in range(5000)]
+        assert ranking._rank_race_times_numpy(times) == ranking._rank_race_times_python(times)
+
+
+class TestLiveLeaderboard:
+    def test_keeps_best_time(self):
+        leaderboard = LiveLeaderboard()
+        assert leaderboard.record("racer1", "Racer1", 100005)
+        assert leaderboard.record("racer2", "Racer2", 100003)
+        assert not leaderboard.record("racer2", "Racer2", 100004)
+        assert leaderboard.record("racer1", "Racer1", 100003)
+        standings = leaderboard.standings()
+        assert [s['login'] for s in standings] == ["racer2", "racer1"]
+        assert [s['rank'] for s in standings] == [1, 1]
+
+    async def test_render_matches_sorting(self):
+        leaderboard = LiveLeaderboard()
+        players = []
+        for nickname, best_race_time in [("Racer1", 100003), ("Racer2", -1), ("Racer3", 100000), ("Racer4", 100003)]:
+            players.append(dict(
+                player=pyplanet.apps.core.maniaplanet.models.Player(nickname=nickname, login=nickname),
+                best_race_time=best_race_time,
+            ))
+            leaderboard.record(nickname, nickname, best_race_time)
+
+        assert leaderboard.finishing_order(players) == [2, 0, 3, 1]
+        live = await render_map_result("Training - 01", players, [], leaderboard)
+        sorted_result = await render_map_result("Training - 01", players, [])
+        assert live['RacerResults'] == sorted_result['RacerResults']
+
+
+class TestNetTimespan:
+    def test_format(self):
+        assert helpers.format_net_timespan(8247) == '0:0:8.247000'
+        assert helpers.format_net_timespan(100002) == '0:1:40.2000'
+        assert helpers.format_net_timespan(3723004) == '1:2:3.4000'
+
+    def test_format_batch(self):
+        times = [8247, 100002, 3723004]
+        assert helpers.format_net_timespans(times) == [helpers.format_net_timespan(t) for t in times]
+
+    def test_parse_round_trip(self):
+        for time in [0, 8247, 100000, 100002, 123456, 3723004]:
+            assert helpers.parse_net_timespan(helpers.format_net_timespan(time)) == time
+
+
+class TestStripStyles:
+    def test_strip(self):
+        assert helpers.strip_styles("$o$f00Red$z $iRacer") == "Red Racer"
+        assert helpers.strip_styles("$$5 Cash") == "$5 Cash"
+
+    async def test_cached_across_maps(self):
+        helpers.strip_styles.cache_clear()
+        players = [dict(player=SimpleNamespace(nickname=f"$f00Racer{n}"), best_race_time=100000 + n)
+                   for n in range(10)]
+
+        await render_map_result("$oTraining - 01", players, [])
+        assert helpers.strip_cache_stats()['misses'] == 11
+        # The second map sees the same nicknames again, so only its track name is new.
+        round_result = await render_map_result("$oTraining - 02", players, [])
+        stats = helpers.strip_cache_stats()
+        assert (stats['hits'], stats['misses'], stats['size']) == (10, 12, 12)
+        assert round_result['RacerResults'][0]['Nick'] == "Racer0"
+
+
+class TestEncoder:
+    round_result = RoundResult("Training - 01", "2025-03-30T21:52:51.961133", [
+        RacerResult("duck\u00e9\"full", 1, "0:1:40.2000"),
+        RacerResult(None, 2),
+    ])
+
+    def test_reads_like_a_dict(self):
+        assert self.round_result == {
+            "TrackName": "Training - 01",
+            "RacedAtUtc": "2025-03-30T21:52:51.961133",
+            "RacerResults": [{"Nick": "duck\u00e9\"full", "Rank": 1, "BestTime": "0:1:40.2000"},
+                             {"Nick": None, "Rank": 2}],
+        }
+        assert self.round_result['RacerResults'][1].get('BestTime') is None
+
+    def test_indented_matches_json(self):
+        expected = json.dumps(self.round_result.to_dict(), indent=4)
+        assert encoder.dumps(self.round_result, indent=True) == expected
+        assert encoder.dumps(RoundResult("Empty", "now", []), indent=True) == \
+            json.dumps({"TrackName": "Empty", "RacedAtUtc": "now", "RacerResults": []}, indent=4)
+
+    def test_compact(self, monkeypatch):
+        expected = json.dumps(self.round_result.to_dict(), separators=(',', ':'), ensure_ascii=False)
+        assert json.loads(encoder.dumps(self.round_result)) == self.round_result.to_dict()
+        monkeypatch.setattr(encoder, 'orjson', None)
+        assert encoder.dumps(self.round_result) == expected
+        assert json.loads(encoder.dumps({"Data": self.round_result})) == {"Data": self.round_result.to_dict()}
+
+    def test_team_results(self, monkeypatch):
+        round_result = RoundResult("Training - 01", "now", [RacerResult("Racer", 1, "0:1:40.0")],
+                                   [TeamResult("Blue", 1, 25, "0:1:40.0", "0:1:40.0"), TeamResult("Red", 2, 0)])
+        assert encoder.dumps(round_result, indent=True) == json.dumps(round_result.to_dict(), indent=4)
+        monkeypatch.setattr(encoder, 'orjson', None)
+        assert encoder.dumps(round_result) == json.dumps(round_result.to_dict(), separators=(',', ':'))
+
+
+class TestMatchResultJournal:
+    async def test_append_and_export(self, tmp_path, monkeypatch):
+        monkeypatch.chdir(tmp_path)
+        os.makedirs("matchresults")
+        await fileio.update_matchresult({"TrackName": "Training - 01", "RacerResults": []})
+        await fileio.update_matchresult({"TrackName": "Training - 02", "RacerResults": []})
+        await fileio.export_matchresult()
+
+        with open(fileio._matchresult_path(fileio._today()), encoding="utf-8") as match_file:
+            data = json.load(match_file)
+        assert [r['TrackName'] for r in data['RoundResults']] == ["Training - 01", "Training - 02"]
+
+    async def test_migrates_existing_day_file(self, tmp_path, monkeypatch):
+        monkeypatch.chdir(tmp_path)
+        os.makedirs("matchresults")
+        with open(fileio._matchresult_path(fileio._today()), 'w', encoding="utf-8") as match_file:
+            json.dump({"RoundResults": [{"TrackName": "Training - 01", "RacerResults": []}]}, match_file)
+
+        await fileio.update_matchresult({"TrackName": "Training - 02", "RacerResults": []})
+
+        round_results = fileio.read_matchresults()
+        assert [r['TrackName'] for r in round_results] == ["Training - 01", "Training - 02"]
+
+    async def test_merges_server_shards(self, tmp_path, monkeypatch):
+        monkeypatch.chdir(tmp_path)
+        os.makedirs("matchresults")
+        for raced_at, server in [("12:00", "heat1"), ("12:01", "heat2"), ("12:02", "heat1")]:
+            monkeypatch.setattr(fileio, 'server_id', server)
+            await fileio.update_matchresult({"TrackName": f"{server} {raced_at}", "RacedAtUtc": raced_at,
+                                             "RacerResults": []}, "2025-03-30")
+            await fileio.export_matchresult("2025-03-30")
+
+        assert os.path.exists("matchresults/2025-03-30.heat1.jsonl")
+        with open(fileio._matchresult_path("2025-03-30"), encoding="utf-8") as match_file:
+            data = json.load(match_file)
+        assert [r['TrackName'] for r in data['RoundResults']] == ["heat1 12:00", "heat2 12:01", "heat1 12:02"]
+
+    async def test_notices_shard_rewritten_in_place(self, tmp_path, monkeypatch):
+        monkeypatch.chdir(tmp_path)
+        os.makedirs("matchresults")
+        monkeypatch.setattr(fileio, 'server_id', "heat1")
+        await fileio.update_matchresult({"TrackName": "Track A", "RacedAtUtc": "12:00", "RacerResults": []},
+                                        "2025-03-30")
+        await fileio.export_matchresult("2025-03-30")
+
+        # Someone fixes a typo in the journal by hand, keeping its size.
+        shard_path = "matchresults/2025-03-30.heat1.jsonl"
+        with open(shard_path, encoding="utf-8") as shard_file:
+            journal = shard_file.read()
+        with open(shard_path, 'r+', encoding="utf-8") as shard_file:
+            shard_file.write(journal.replace("Track A", "Track B"))
+        os.utime(shard_path, ns=(time.time_ns() + 10 ** 9,) * 2)
+
+        await fileio.export_matchresult("2025-03-30")
+        with open(fileio._matchresult_path("2025-03-30"), encoding="utf-8") as match_file:
+            assert [r['TrackName'] for r in json.load(match_file)['RoundResults']] == ["Track B"]
+
+    def test_concurrent_servers(self, tmp_path):
+        os.makedirs(tmp_path / "matchresults")
+        context = multiprocessing.get_context('spawn')
+        servers = [context.Process(target=_save_rounds, args=(str(tmp_path), f"heat{n}", 10)) for n in range(3)]
+        for server in servers:
+            server.start()
+        for server in servers:
+            server.join()
+            assert server.exitcode == 0
+
+        with open(tmp_path / "matchresults" / "2025-03-30.json", encoding="utf-8") as match_file:
+            assert len(json.load(match_file)['RoundResults']) == 30
+        with open(tmp_path / fileio.STANDINGS_INDEX_PATH, encoding="utf-8") as index_file:
+            assert json.load(index_file)['RoundsCounted'] == 30
+
+
+def _save_rounds(directory: str, server: str, rounds: int):
+    # Plays one server's rounds into a shared matchresults directory, exporting the day file after each.
+    os.chdir(directory)
+    fileio.set_server_id(server)
+
+    async def save_rounds():
+        for n in range(rounds):
+            await fileio.update_matchresult({"TrackName": f"Training - {n:02d}", "RacedAtUtc": f"12:{n:02d} {server}",
+                                             "RacerResults": [{"Nick": server, "Rank": 1}]}, "2025-03-30")
+            await fileio.export_matchresult("2025-03-30")
+        await fileio.save_standings()
+
+    asyncio.run(save_rounds())
+
+
+class TestDayCache:
+    @staticmethod
+    def read_day_file(day: str) -> str:
+        with open(fileio._matchresult_path(day), encoding="utf-8") as match_file:
+            return match_file.read()
+
+    async def test_appends_without_rereading(self, tmp_path, monkeypatch):
+        monkeypatch.chdir(tmp_path)
+        os.makedirs("matchresults")
+        reads = []
+        read_shard = fileio._read_shard
+        monkeypatch.setattr(fileio, '_read_shard', lambda *args: reads.append(args) or read_shard(*args))
+
+        for n in range(1, 4):
+            await fileio.update_matchresult({"TrackName": f"Training - 0{n}", "RacedAtUtc": f"12:0{n}",
+                                             "RacerResults": [{"Nick": "Racer", "Rank": 1}]}, "2025-03-31")
+            await fileio.export_matchresult("2025-03-31")
+
+        # Every round came from the cache, and the spliced day file is exactly what json.dumps would write.
+        assert reads == []
+        assert self.read_day_file("2025-03-31") == json.dumps(
+            {"RoundResults": fileio.read_matchresults("2025-03-31")}, indent=4)
+
+    async def test_reloads_on_rewrite_and_rollover(self, tmp_path, monkeypatch):
+        monkeypatch.chdir(tmp_path)
+        os.makedirs("matchresults")
+        await fileio.update_matchresult({"TrackName": "Track A", "RacedAtUtc": "12:00", "RacerResults": []},
+                                        "2025-04-01")
+        await fileio.export_matchresult("2025-04-01")
+
+        # An external rewrite that grows the journal is not mistaken for an append.
+        with open(fileio._journal_path("2025-04-01"), 'w', encoding="utf-8") as journal_file:
+            for track_name in ["Track X", "Track Y"]:
+                journal_file.write(json.dumps({"TrackName": track_name, "RacedAtUtc": "12:00",
+                                               "RacerResults": []}) + '\n')
+        await fileio.export_matchresult("2025-04-01")
+        assert [r['TrackName'] for r in json.loads(self.read_day_file("2025-04-01"))['RoundResults']] == [
+            "Track X", "Track Y"]
+
+        # The next day starts from an empty cache.
+        await fileio.update_matchresult({"TrackName": "Track B", "RacedAtUtc": "12:00", "RacerResults": []},
+                                        "2025-04-02")
+        await fileio.export_matchresult("2025-04-02")
+        assert [r['TrackName'] for r in json.loads(self.read_day_file("2025-04-02"))['RoundResults']] == [
+            "Track B"]
+
+
+class TestIoExecutor:
+    async def test_runs_off_the_event_loop(self):
+        def blocking_write():
+            time.sleep(0.2)
+            return threading.current_thread().name
+
+        ticks = 0
+
+        async def ticker():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.01)
+                ticks += 1
+
+        count = fileio.io_latency_stats()['count']
+        ticking = asyncio.ensure_future(ticker())
+        thread_name = await fileio.run_io(blocking_write)
+        ticking.cancel()
+
+        assert thread_name.startswith('rankingsaver-io')
+        # The loop kept running while the write blocked its thread.
+        assert ticks >= 5
+        stats = fileio.io_latency_stats()
+        assert stats['count'] == count + 1
+        assert stats['last_ms'] >= 200
+
+    @pytest.mark.skipif(sys.version_info >= (3, 12), reason="the event loop's profiler sees every thread")
+    async def test_profiles_io_jobs(self, tmp_path):
+        def blocking_write():
+            time.sleep(0.01)
+
+        fileio.start_io_profile()
+        await fileio.run_io(blocking_write)
+        profiles = fileio.stop_io_profile()
+        await fileio.run_io(blocking_write)
+
+        assert len(profiles) == 1
+        await fileio.dump_profile(str(tmp_path / "profile.prof"), profiles)
+        functions = [function for _, _, function in pstats.Stats(str(tmp_path / "profile.prof")).stats]
+        assert functions.count('blocking_write') == 1
+
+    async def test_runs_jobs_when_profiling_is_busy(self, monkeypatch):
+        class BusyProfile(cProfile.Profile):
+            def enable(self):
+                raise ValueError("Another profiling tool is already active")
+
+        monkeypatch.setattr(fileio.cProfile, 'Profile', BusyProfile)
+        monkeypatch.setattr(fileio, '_io_profiles', [])
+
+        assert await fileio.run_io(threading.current_thread) is not threading.current_thread()
+        assert fileio.stop_io_profile() == []
+
+    async def test_saves_on_the_writer_threads(self, tmp_path, monkeypatch):
+        monkeypatch.chdir(tmp_path)
+        os.makedirs("matchresults")
+        writers = set()
+        write_durable = fileio._write_durable
+
+        def recording_write_durable(*args, **kwargs):
+            writers.add(threading.current_thread().name)
+            return write_durable(*args, **kwargs)
+
+        monkeypatch.setattr(fileio, '_write_durable', recording_write_durable)
+        await fileio.update_matchresult({"TrackName": "Training - 01", "RacedAtUtc": "now", "RacerResults": []})
+        await fileio.export_matchresult()
+
+        assert writers and all(name.startswith('rankingsaver-io') for name in writers)
+
+
+class TestStandings:
+    round_1 = {"TrackName": "Training - 01", "RacerResults": [
+        {"Nick": "Racer1", "Rank": 1, "BestTime": "0:1:40.0"},
+        {"Nick": "Racer2", "Rank": 2, "BestTime": "0:1:40.2000"},
+        {"Nick": "Racer3", "Rank": 3}]}
+    round_2 = {"TrackName": "Training - 01", "RacerResults": [
+        {"Nick": "Racer2", "Rank": 1, "BestTime": "0:1:39.0"},
+        {"Nick": "Racer1", "Rank": 2, "BestTime": "0:1:41.0"}]}
+
+    def test_table(self):
+        standings = StandingsIndex()
+        standings.add_round(self.round_1)
+        standings.add_round(self.round_2)
+        table = standings.table()
+        # Racer2 set the fastest time, which breaks the tie on points.
+        assert [(row['Nick'], row['Rank'], row['Points']) for row in table] == [
+            ("Racer2", 1, 43), ("Racer1", 2, 43), ("Racer3", 3, 0)]
+        assert table[1]['BestTimes'] == {"Training - 01": "0:1:40.0"}
+        assert table[2]['MapsPlayed'] == 1
+
+    def test_team_table(self):
+        standings = StandingsIndex()
+        standings.add_round(dict(self.round_1, TeamResults=[
+            {"Team": "Blue", "Rank": 1, "Points": 40, "BestTime": "0:1:40.0"}, {"Team": "Red", "Rank": 2, "Points": 0}]))
+        standings.add_round(dict(self.round_2, TeamResults=[
+            {"Team": "Red", "Rank": 1, "Points": 25, "BestTime": "0:1:39.0"}]))
+        standings = StandingsIndex(json.loads(json.dumps(standings.to_dict())))
+        assert [(row['Team'], row['Rank'], row['Points'], row['MapsPlayed']) for row in standings.team_table()] == [
+            ("Blue", 1, 40, 1), ("Red", 2, 25, 2)]
+        assert standings.team_table()[1]['BestTimes'] == {"Training - 01": "0:1:39.0"}
+
+    async def test_built_from_history_once(self, tmp_path, monkeypatch):
+        monkeypatch.chdir(tmp_path)
+        os.makedirs("matchresults")
+        with open("matchresults/2025-03-30.json", 'w', encoding="utf-8") as match_file:
+            json.dump({"RoundResults": [self.round_1]}, match_file)
+
+        await fileio.update_matchresult(self.round_2)
+        await fileio.save_standings()
+
+        with open(fileio.STANDINGS_INDEX_PATH, encoding="utf-8") as index_file:
+            assert json.load(index_file)['RoundsCounted'] == 2
+
+    async def test_before_start(self, tmp_path, monkeypatch):
+        monkeypatch.chdir(tmp_path)
+
+        # //tbg start hasn't created the matchresults directory yet.
+        assert await fileio.standings_table() == []
+        await fileio.save_standings()
+
+    async def test_snapshots_and_catches_up(self, tmp_path, monkeypatch):
+        monkeypatch.chdir(tmp_path)
+        monkeypatch.setattr(fileio, 'STANDINGS_SNAPSHOT_ROUNDS', 2)
+        os.makedirs("matchresults")
+        for round_result in [self.round_1, self.round_2, self.round_1]:
+            await fileio.update_matchresult(round_result, "2025-03-30")
+
+        # Only every second round is snapshotted; the third is still only in the journal.
+        with open(fileio.STANDINGS_INDEX_PATH, encoding="utf-8") as index_file:
+            assert json.load(index_file)['RoundsCounted'] == 2
+
+        # The server stops between journaling a round and counting it.
+        with open("matchresults/2025-03-30.jsonl", 'a', encoding="utf-8") as journal_file:
+            journal_file.write(json.dumps(self.round_2) + '\n')
+
+        # On the next start, everything journaled after the snapshot is counted.
+        table = await fileio.standings_table()
+        assert fileio._standings.rounds_counted == 4
+        assert [(row['Nick'], row['Points']) for row in table][:2] == [("Racer2", 18 + 25 + 18 + 25),
+                                                                       ("Racer1", 25 + 18 + 25 + 18)]
+
+    def test_tiebreak(self):
+        standings = StandingsIndex()
+        standings.add_round({"TrackName": "Training - 01", "RacerResults": [
+            {"Nick": "Racer B", "Rank": 1, "BestTime": "0:1:40.0"},
+            {"Nick": "Racer A", "Rank": 1, "BestTime": "0:1:40.0"}]})
+        assert [(row['Nick'], row['Rank']) for row in standings.table()] == [("Racer A", 1), ("Racer B", 1)]
+
+
+class TestRawArchive:
+    def test_append_and_read(self, tmp_path):
+        archive = RawArchive(str(tmp_path / "raw"), max_segment_bytes=1)
+        archive.append("2025-03-30T21:52:51.961133", {"Players": [{"best_race_time": 100000}]})
+        archive.append("2025-03-30T21:58:12.000000", {"Players": []})
+
+        # Every dump went into its own segment.
+        assert len(list((tmp_path / "raw").glob("segment-*.gz"))) == 2
+        reopened = RawArchive(str(tmp_path / "raw"))
+        assert reopened.keys() == ["2025-03-30T21:52:51.961133", "2025-03-30T21:58:12.000000"]
+        assert reopened.read("2025-03-30T21:52:51.961133") == {"Players": [{"best_race_time": 100000}]}
+        assert reopened.read("missing") is None
+
+    def test_append_after_torn_index_line(self, tmp_path):
+        archive = RawArchive(str(tmp_path / "raw"))
+        archive.append("2025-03-30T21:52:51.961133", {"Players": []})
+        with open(tmp_path / "raw" / "segment-00001.idx", 'a', encoding="utf-8") as index_file:
+            index_file.write('{"Key": "2025-03-30T21:5')
+
+        archive.append("2025-03-30T21:58:12.000000", {"Players": [{"best_race_time": 100000}]})
+        reopened = RawArchive(str(tmp_path / "raw"))
+        assert reopened.keys() == ["2025-03-30T21:52:51.961133", "2025-03-30T21:58:12.000000"]
+        assert reopened.read("2025-03-30T21:58:12.000000") == {"Players": [{"best_race_time": 100000}]}
+
+    def test_sees_other_writers(self, tmp_path):
+        reader = RawArchive(str(tmp_path / "raw"))
+        writer = RawArchive(str(tmp_path / "raw"))
+        writer.append("2025-03-30T21:52:51.961133", {"Players": []})
+        assert reader.keys() == ["2025-03-30T21:52:51.961133"]
+        writer.append("2025-03-30T21:58:12.000000", {"Players": []})
+        assert "2025-03-30T21:58:12.000000" in reader
+        assert reader.read("2025-03-30T21:58:12.000000") == {"Players": []}
+
+    def test_migrate(self, tmp_path):
+        with open(tmp_path / "raw_2025-03-30T21:52:51.961133.json", 'w', encoding="utf-8") as raw_file:
+            json.dump({"Players": []}, raw_file)
+        archive = RawArchive(str(tmp_path / "raw"))
+
+        assert migrate_raw_files(str(tmp_path), archive, remove=True) == 1
+        assert migrate_raw_files(str(tmp_path), archive) == 0
+        assert archive.read("2025-03-30T21:52:51.961133") == {"Players": []}
+        assert not (tmp_path / "raw_2025-03-30T21:52:51.961133.json").exists()
+
+    def test_migrate_waits_for_the_server(self, tmp_path):
+        with open(tmp_path / "raw_2025-03-30T21:52:51.961133.json", 'w', encoding="utf-8") as raw_file:
+            json.dump({"Players": []}, raw_file)
+        archive = RawArchive(str(tmp_path / "raw"))
+
+        # The server holds the archive's lock while it dumps.
+        with process_lock(archive.directory):
+            migration = threading.Thread(target=migrate_raw_files, args=(str(tmp_path), archive))
+            migration.start()
+            migration.join(0.2)
+            assert migration.is_alive()
+            assert not os.path.exists(archive.directory)
+        migration.join()
+
+        assert archive.keys() == ["2025-03-30T21:52:51.961133"]
+
+
+class TestRecovery:
+    def test_tail_lines(self, tmp_path):
+        with open(tmp_path / "lines", 'w', encoding="utf-8") as f:
+            f.write(''.join(f"line {n}\n" for n in range(1000)))
+        assert helpers.tail_lines(str(tmp_path / "lines"), 3, block_size=16) == ["line 997", "line 998", "line 999"]
+        assert len(helpers.tail_lines(str(tmp_path / "lines"), 5000)) == 1000
+
+    async def test_state_checkpoint(self, tmp_path, monkeypatch):
+        monkeypatch.chdir(tmp_path)
+        assert await fileio.read_state() == {}
+        await fileio.write_state({'Enabled': True, 'Running': False})
+        assert await fileio.read_state() == {'Enabled': True, 'Running': False}
+
+    async def test_rerenders_unjournaled_dumps(self, tmp_path, monkeypatch):
+        monkeypatch.chdir(tmp_path)
+        os.makedirs("matchresults")
+        players = [{"best_race_time": 100002, "best_lap_time": 100002, "nickname": "Racer", "login": "racer"}]
+        # Midday keys land on the same local day whatever the timezone.
+        fileio.raw_archive.append("2025-03-30T11:00:00.000000", {"Players": players})
+        fileio.raw_archive.append("2025-03-30T12:00:00.000000", {"MapName": "Track 1", "Players": players})
+        fileio.raw_archive.append("2025-03-30T12:05:00.000000", {"MapName": "Track 2", "Players": players})
+        await fileio.update_matchresult({"TrackName": "Track 1", "RacedAtUtc": "2025-03-30T12:00:00.000000",
+                                         "RacerResults": []}, "2025-03-30")
+
+        # The dump from before map names were recorded can't be matched, so it is left alone.
+        assert await recover_matchresults() == ["2025-03-30T12:05:00.000000"]
+        assert await recover_matchresults() == []
+        round_results = fileio.read_matchresults("2025-03-30")
+        assert [r['TrackName'] for r in round_results] == ["Track 1", "Track 2"]
+        assert round_results[1]['RacerResults'] == [{"Nick": "Racer", "Rank": 1, "BestTime": "0:1:40.2000"}]
+
+
+class TestRerender:
+    def test_rerender_archive_and_raw_files(self, tmp_path):
+        # Midday keys land on the same local day whatever the timezone.
+        archive = RawArchive(str(tmp_path / "matchresults" / "raw"))
+        archive.append("2025-03-30T12:52:51.961133", {"MapName": "$f00Test Map", "Players": [
+            {"best_race_time": -1, "best_lap_time": -1, "nickname": "Slow Racer", "login": "slow"},
+            {"best_race_time": 100002, "best_lap_time": 100002, "nickname": "$0f0Fast Racer", "login": "fast"},
+        ]})
+        with open(tmp_path / "matchresults" / "raw_2025-03-31T12:00:00.000000.json", 'w', encoding="utf-8") as f:
+            json.dump({"Players": [{"best_race_time": "UNKNOWN", "best_lap_time": "UNKNOWN"}]}, f)
+
+        rerender_main(["--directory", str(tmp_path / "matchresults"), "--output", str(tmp_path / "out"),
+                       "--workers", "2"])
+
+        with open(tmp_path / "out" / "2025-03-30.json", 'r', encoding="utf-8") as f:
+            assert json.load(f) == {"RoundResults": [{
+                "TrackName": "Test Map",
+                "RacedAtUtc": "2025-03-30T12:52:51.961133",
+                "RacerResults": [
+                    {"Nick": "Fast Racer", "Rank": 1, "BestTime": "0:1:40.2000"},
+                    {"Nick": "Slow Racer", "Rank": 2},
+                ],
+            }]}
+        with open(tmp_path / "out" / "2025-03-31.json", 'r', encoding="utf-8") as f:
+            assert json.load(f)["RoundResults"][0]["TrackName"] == "Unknown Track"
+
+
+class TestSplits:
+    async def test_record_and_map(self, tmp_path, monkeypatch):
+        monkeypatch.chdir(tmp_path)
+        os.makedirs("matchresults")
+        players = [
+            {"best_race_time": 20165, "best_lap_time": 20165, "best_race_checkpoints": [4516, 7213, 20165],
+             "player": SimpleNamespace(login="racer", nickname="$f00Racer")},
+            {"best_race_time": -1, "best_lap_time": -1, "best_race_checkpoints": [],
+             "player": SimpleNamespace(login="dnf", nickname="DNF")},
+        ]
+        await fileio.dump_mapend_raw(players, [], "Training - 01", "2025-03-30T21:52:51.961133", record_splits=True)
+
+        with SplitsArchive("matchresults/splits").read("2025-03-30T21:52:51.961133") as splits:
+            assert len(splits) == 2
+            assert (splits.login(0), splits.nickname(0)) == ("racer", "$f00Racer")
+            assert list(splits.checkpoints(0)) == [4516, 7213, 20165]
+            assert splits.sectors(0) == [4516, 2697, 12952]
+            assert list(splits.best_race_times) == [20165, -1]
+            assert list(splits.checkpoints(1)) == []
+            if helpers.numpy is not None:
+                assert list(splits.to_numpy()['checkpoint_times']) == [4516, 7213, 20165]
+
+
+class TestResultStore:
+    def test_history_queries(self, tmp_path):
+        store = ResultStore(str(tmp_path / "results.sqlite3"))
+        store.add_round({"TrackName": "Training - 01", "RacedAtUtc": "2025-03-30T21:52:51.961133", "RacerResults": [
+            {"Nick": "Racer1", "Rank": 1, "BestTime": "0:1:40.0"},
+            {"Nick": "Racer2", "Rank": 2}]})
+        store.add_round({"TrackName": "Training - 01", "RacedAtUtc": "2025-03-31T10:00:00.000000", "RacerResults": [
+            {"Nick": "Racer2", "Rank": 1, "BestTime": "0:1:39.2000"},
+            {"Nick": "Racer1", "Rank": 2, "BestTime": "0:1:41.0"}]})
+        store.add_raw_dump("2025-03-31T10:00:00.000000", {"Players": [
+            {"login": "racer1", "nickname": "Racer1", "best_race_time": 101000, "best_lap_time": 'UNKNOWN'}]})
+
+        best_times = store.best_times("Training - 01")
+        assert [(row['Nick'], row['BestTime']) for row in best_times] == [
+            ("Racer2", "0:1:39.2000"), ("Racer1", "0:1:40.0")]
+        assert best_times[1]['RacedAtUtc'] == "2025-03-30T21:52:51.961133"
+
+        history = store.player_history("Racer2")
+        assert [row['Rank'] for row in history] == [1, 2]
+        assert history[1].get('BestTime') is None
+        store.close()
+
+    async def test_opens_before_start(self, tmp_path, monkeypatch):
+        monkeypatch.chdir(tmp_path)
+
+        # //tbg start hasn't created the matchresults directory yet.
+        await fileio.open_result_store()
+        assert await fileio.query_result_store(ResultStore.best_times, "Training - 01") == []
+        await fileio.close_result_store()
+
+    async def test_imports_recorded_rounds(self, tmp_path, monkeypatch):
+        monkeypatch.chdir(tmp_path)
+        os.makedirs("matchresults")
+        for day, raced_at, best_time in [("2025-03-30", "2025-03-30T21:52:51.961133", "0:1:40.0"),
+                                         ("2025-03-31", "2025-03-31T10:00:00.000000", "0:1:39.2000")]:
+            await fileio.update_matchresult({"TrackName": "Training - 01", "RacedAtUtc": raced_at, "RacerResults": [
+                {"Nick": "Racer1", "Rank": 1, "BestTime": best_time}]}, day)
+
+        # A new database starts out with the rounds recorded before it was turned on.
+        await fileio.open_result_store()
+        history = await fileio.query_result_store(ResultStore.player_history, "Racer1")
+        assert [row['BestTime'] for row in history] == ["0:1:39.2000", "0:1:40.0"]
+
+        # Later rounds are copied as they are saved, and only imported the once.
+        await fileio.update_matchresult({"TrackName": "Training - 02", "RacedAtUtc": "2025-04-01T10:00:00.000000",
+                                         "RacerResults": [{"Nick": "Racer1", "Rank": 2}]}, "2025-04-01")
+        await fileio.close_result_store()
+        await fileio.open_result_store()
+        history = await fileio.query_result_store(ResultStore.player_history, "Racer1")
+        assert [(row['TrackName'], row['Rank']) for row in history] == [
+            ("Training - 02", 2), ("Training - 01", 1), ("Training - 01", 1)]
+        await fileio.close_result_store()
+
+    def test_stores_a_round_once(self, tmp_path):
+        store = ResultStore(str(tmp_path / "results.sqlite3"))
+        round_result = {"TrackName": "Training - 01", "RacedAtUtc": "2025-03-30T21:52:51.961133", "RacerResults": [
+            {"Nick": "Racer1", "Rank": 1, "BestTime": "0:1:40.0"}]}
+        store.add_round(round_result)
+
+        assert not store.imported
+        assert store.import_rounds([round_result]) == 0
+        assert store.imported
+        assert len(store.player_history("Racer1")) == 1
+        store.close()
+
+
+class TestPushServer:
+    async def test_resume_and_stream(self):
+        server = PushServer()
+        await server.start()
+        server.publish('RoundResult', {"TrackName": "Training - 01"})
+        server.publish('RoundResult', {"TrackName": "Training - 02"})
+
+        reader, writer = await asyncio.open_connection('127.0.0.1', server.port)
+        writer.write((json.dumps({"Run": server.run, "Since": 1}) + '\n').encode("utf-8"))
+        event = json.loads(await reader.readline())
+        assert (event['Run'], event['Seq'], event['Data']['TrackName']) == (server.run, 2, "Training - 02")
+
+        server.publish('Leaderboard', {"Nick": "Racer1", "Rank": 1})
+        event = json.loads(await reader.readline())
+        assert (event['Seq'], event['Type']) == (3, 'Leaderboard')
+
+        writer.close()
+        await server.stop()
+
+    async def test_resync_after_restart(self):
+        server = PushServer()
+        await server.start()
+
+        reader, writer = await asyncio.open_connection('127.0.0.1', server.port)
+        writer.write(b'{"Since": 41}\n')
+        event = json.loads(await reader.readline())
+        assert (event['Run'], event['Seq'], event['Type']) == (server.run, 0, 'Resync')
+
+        writer.close()
+        await server.stop()
+
+    async def test_resync(self):
+        server = PushServer()
+        await server.start()
+        for n in range(3):
+            server.publish('RoundResult', {"TrackName": f"Training - 0{n}"})
+
+        # A previous run's sequence numbers mean nothing in this one, even where they overlap.
+        hellos = [{"Run": "a previous run", "Since": 1}, {"Run": server.run, "Since": -1},
+                  {"Run": server.run, "Since": "1"}, {"Run": server.run, "Since": True}]
+        for hello in hellos:
+            reader, writer = await asyncio.open_connection('127.0.0.1', server.port)
+            writer.write((json.dumps(hello) + '\n').encode("utf-8"))
+            event = json.loads(await reader.readline())
+            assert (event['Seq'], event['Type']) == (3, 'Resync'), hello
+            writer.close()
+
+        empty_server = PushServer()
+        assert empty_server._backlog(empty_server.run, -1)[0].endswith(b'"Type":"Resync"}\n')
+        await server.stop()
+
+    async def test_port_in_use(self):
+        server = PushServer()
+        await server.start()
+        app = make_app()
+        app.push_server = None
+
+        # The app carries on without pushing.
+        await app.start_push_server(server.port)
+        assert app.push_server is None
+        await server.stop()
+
+
+class FakeGbx:
+    """
+    Stands in for the dedicated server's GBX endpoint, recording every round-trip made to it.
+    """
+
+    def __init__(self, faults=None):
+        self.round_trips = []
+        self.faults = faults or {}
+
+    def __call__(self, method, *args):
+        return FakeQuery(self, method, args)
+
+    def answer(self, query):
+        if query.method in self.faults:
+            return {'faultCode': -1000, 'faultString': self.faults[query.method]}
+        return True
+
+    async def multicall(self, *queries):
+        self.round_trips.append([(query.method, query.args) for query in queries])
+        return [self.answer(query) for query in queries]
+
+
+class FakeQuery:
+    def __init__(self, gbx, method, args):
+        self.gbx = gbx
+        self.method = method
+        self.args = args
+
+    async def execute(self):
+        self.gbx.round_trips.append([(self.method, self.args)])
+        result = self.gbx.answer(self)
+        if isinstance(result, dict):
+            raise Fault(result['faultCode'], result['faultString'])
+        return result
+
+
+class FakeInstance:
+    def __init__(self, gbx):
+        self.gbx = gbx
+
+    def chat(self, message, *players):
+        if players:
+            return SimpleNamespace(gbx_query=self.gbx('ChatSendServerMessageToLogin', message,
+                                                      ','.join(player.login for player in players)))
+        return SimpleNamespace(gbx_query=self.gbx('ChatSendServerMessage', message))
+
+
+class TestOutboundBatcher:
+    async def test_coalesces_into_one_multicall(self):
+        gbx = FakeGbx()
+        outbound = OutboundBatcher(FakeInstance(gbx), window=0.01)
+        outbound.chat("Congratulations!")
+        outbound.chat("Saved.", SimpleNamespace(login='racer'))
+        assert await outbound.gbx('RestartMap') is True
+
+        assert gbx.round_trips == [[
+            ('ChatSendServerMessage', ("Congratulations!",)),
+            ('ChatSendServerMessageToLogin', ("Saved.", 'racer')),
+            ('RestartMap', ()),
+        ]]
+
+    async def test_faults(self):
+        gbx = FakeGbx(faults={'RestartMap': 'Not allowed', 'ChatSendServerMessageToLogin': 'Login unknown.'})
+        outbound = OutboundBatcher(FakeInstance(gbx), window=0.01)
+        chat = outbound.chat("Hello", SimpleNamespace(login='gone'))
+        restart = outbound.gbx('RestartMap')
+        # A message to a player who has left is not an error, but a failed call is.
+        assert await chat is True
+        with pytest.raises(Fault):
+            await restart
+
+        # A lone call is sent as it is, and so is anything left over on close.
+        outbound.gbx('NextMap')
+        await outbound.close()
+        assert gbx.round_trips[-1] == [('NextMap', ())]
+
+
+def make_app(gbx=None) -> RankingSaverApp:
+    """
+    Builds the app around a FakeInstance, with tracking on, without going through PyPlanet's app registry.
+    """
+    app = RankingSaverApp.__new__(RankingSaverApp)
+    app.instance = FakeInstance(gbx or FakeGbx())
+    app.instance.map_manager = SimpleNamespace(current_map=SimpleNamespace(name="$oTraining - 01"))
+    app.enabled = True
+    app.running = True
+    app.profile_next_map = False
+    app.leaderboard = LiveLeaderboard()
+    app.push_server = None
+    app.outbound = OutboundBatcher(app.instance)
+
+    async def record_splits():
+        return False
+
+    app.setting_record_splits = SimpleNamespace(get_value=record_splits)
+    return app
+
+
+class TestEndMap:
+    async def test_logs_both_failures(self, tmp_path, monkeypatch, caplog):
+        monkeypatch.chdir(tmp_path)
+        app = make_app()
+
+        async def fail(*args, **kwargs):
+            raise OSError(f"{len(args)} argument failure")
+
+        monkeypatch.setattr(app_module, 'update_matchresult', fail)
+        monkeypatch.setattr(app_module, 'dump_mapend_raw', fail)
+        players = [dict(player=SimpleNamespace(nickname="Racer", login="racer"), best_race_time=100000)]
+
+        with pytest.raises(OSError, match="5 argument failure"):
+            await app.scores('EndMap', players, [])
+        # The raw dump's error is raised, but the match results' error is logged too.
+        assert "1 argument failure" in caplog.text
+        await app.outbound.close()
+
+    async def test_standings_command(self, tmp_path, monkeypatch):
+        monkeypatch.chdir(tmp_path)
+        os.makedirs("matchresults")
+        gbx = FakeGbx()
+        app = make_app(gbx)
+        await fileio.update_matchresult({"TrackName": "Training - 01", "RacedAtUtc": "now", "RacerResults": [
+            {"Nick": "Racer1", "Rank": 1, "BestTime": "0:1:40.0"}]})
+
+        await app.match_standings(SimpleNamespace(login="racer2"), None)
+        await app.outbound.close()
+
+        [[(method, (message, login))]] = gbx.round_trips
+        assert "1. $zRacer1$z$fff (25)" in message and login == "racer2"
+        # Asking doesn't write the export file; the export timer does.
+        assert not os.path.exists(fileio.STANDINGS_EXPORT_PATH)
+        await fileio.export_pending_matchresults()
+        assert os.path.exists(fileio.STANDINGS_EXPORT_PATH)
+
+    async def test_stop_finishes_teardown(self, tmp_path, monkeypatch, caplog):
+        monkeypatch.chdir(tmp_path)
+        app = make_app()
+        app.export_task = app.live_standings_task = None
+        stopped = []
+
+        async def fail():
+            raise OSError("standings failure")
+
+        async def close_result_store():
+            stopped.append('result_store')
+
+        async def stop_push_server():
+            stopped.append('push_server')
+
+        monkeypatch.setattr(app_module, 'save_standings', fail)
+        monkeypatch.setattr(app_module, 'close_result_store', close_result_store)
+        app.push_server = SimpleNamespace(stop=stop_push_server)
+        app.outbound.chat("Goodbye")
+
+        await app.on_stop()
+
+        # A failing step is logged, and every step after it still runs.
+        assert "standings failure" in caplog.text
+        assert stopped == ['result_store', 'push_server']
+        assert app.push_server is None
+        assert app.outbound.calls_sent == 1
+
+    async def test_teams(self, tmp_path, monkeypatch):
+        monkeypatch.chdir(tmp_path)
+        os.makedirs("matchresults")
+        app = make_app()
+        players = [dict(player=SimpleNamespace(nickname=f"Racer{n}", login=f"racer{n}",
+                                               flow=SimpleNamespace(team_id=team_id)), best_race_time=race_time)
+                   for n, (team_id, race_time) in enumerate([(0, 100000), (1, 100100)], 1)]
+        teams = [{'id': 0, 'name': "$00fBlue", 'map_points': 0}, {'id': 1, 'name': "$f00Red", 'map_points': 0}]
+
+        await app.scores('EndMap', players, teams, use_teams=True)
+        app.instance.map_manager.current_map.name = "Training - 02"
+        await app.scores('EndMap', players, teams, use_teams=False)
+        await app.outbound.close()
+
+        first, second = fileio.read_matchresults()
+        assert [(team['Team'], team['Rank']) for team in first['TeamResults']] == [("Blue", 1), ("Red", 2)]
+        # Outside team modes the teams PyPlanet passes along are not scored.
+        assert 'TeamResults' not in second
+
+    async def test_profile(self, tmp_path, monkeypatch):
+        monkeypatch.chdir(tmp_path)
+        os.makedirs("matchresults")
+        app = make_app()
+        app.profile_next_map = True
+        players = [dict(player=SimpleNamespace(nickname="Racer", login="racer"), best_race_time=100000)]
+
+        await app.scores('EndMap', players, [])
+        await app.outbound.close()
+
+        # Profiling never gets in the way of saving the round.
+        assert [r['TrackName'] for r in fileio.read_matchresults()] == ["Training - 01"]
+        assert len(fileio.raw_archive.keys()) == 1
+        # The profile covers the journal write on the I/O threads as well as the event loop.
+        profiles = glob.glob("matchresults/profile_*.prof")
+        functions = {function for _, _, function in pstats.Stats(profiles[0]).stats}
+        assert {'end_map', '_append_matchresult'} <= functions
+
+
+class TestMetrics:
+    def test_histogram(self):
+        histogram = metrics.Histogram()
+        for ms in range(1, 101):
+            histogram.observe(ms / 1000)
+        assert histogram.count == 100
+        percentiles = histogram.percentiles()
+        assert percentiles[0.5] == 0.051
+        assert percentiles[0.99] == 0.1
+
+    def test_prometheus_text(self):
+        with metrics.span('test.phase'):
+            pass
+        text = metrics.prometheus_text()
+        assert 'rankingsaver_phase_seconds_bucket{phase="test.phase",le="+Inf"} 1' in text
+        assert 'rankingsaver_phase_seconds_count{phase="test.phase"} 1' in text
+
+    async def test_writes_before_start(self, tmp_path, monkeypatch):
+        monkeypatch.chdir(tmp_path)
+        with metrics.span('test.phase'):
+            pass
+
+        # //tbg start hasn't created the matchresults directory yet.
+        await fileio.write_metrics()
+
+        with open(fileio.METRICS_PATH, encoding="utf-8") as metrics_file:
+            assert 'phase="test.phase"' in metrics_file.read()